@@ -0,0 +1,70 @@
+import threading
+import weakref
+import geopandas as gpd
+
+
+class Admin_Index:
+    """
+    Lookup tables of an admin units (Geo)DataFrame, built once: the children ids of every
+    parent and the geometry of every id (reprojected at most once per CRS).
+    Use Admin_Index.of to share the same index between all the regions of a run.
+    """
+
+    # id(DataFrame) -> (weak reference to the DataFrame, {(subregion_col, parent_col): index})
+    _cache = {}
+    _lock = threading.Lock()  # regions are usually built from a thread pool
+
+    def __init__(self, gpd_admin_units, subregion_col: str, parent_region_col: str):
+        self.subregion_col = subregion_col
+        self.parent_region_col = parent_region_col
+
+        ids = gpd_admin_units[subregion_col]
+        self.children_ids = {
+            parent: group.tolist()
+            for parent, group in ids.groupby(gpd_admin_units[parent_region_col], sort=False)
+        }
+
+        self.crs = None
+        self._projections = []  # [(crs, {id: geometry})]
+        if isinstance(gpd_admin_units, gpd.GeoDataFrame):
+            self.crs = gpd_admin_units.crs
+            self._geoseries = gpd.GeoSeries(
+                gpd_admin_units.geometry.values, index=ids.values, crs=self.crs
+            )
+            self._geoseries = self._geoseries[~self._geoseries.index.duplicated()]
+            self._projections.append((self.crs, self._geoseries.to_dict()))
+
+    @classmethod
+    def of(cls, gpd_admin_units, subregion_col: str, parent_region_col: str):
+        key = (subregion_col, parent_region_col)
+        with cls._lock:
+            ref, indexes = cls._cache.get(id(gpd_admin_units), (None, None))
+            if ref is None or ref() is not gpd_admin_units:
+                indexes = {}
+                cls._cache[id(gpd_admin_units)] = (weakref.ref(gpd_admin_units), indexes)
+
+            if key not in indexes:
+                indexes[key] = cls(gpd_admin_units, subregion_col, parent_region_col)
+            return indexes[key]
+
+    def children(self, parent_name):
+        return self.children_ids.get(parent_name, [])
+
+    def geometry(self, region_id, crs=None):
+        return self.geometries(crs).get(region_id)
+
+    def geometries(self, crs=None):
+        """
+        {id: geometry} in the given CRS, reprojecting all the admin units at the first request.
+        """
+        if crs is None:
+            return self._projections[0][1]
+
+        with self._lock:
+            for projection_crs, geometries in self._projections:
+                if projection_crs == crs:
+                    return geometries
+
+            geometries = self._geoseries.to_crs(crs).to_dict()
+            self._projections.append((crs, geometries))
+            return geometries
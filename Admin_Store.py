@@ -0,0 +1,141 @@
+import json
+import os
+import shutil
+import threading
+import uuid
+from urllib.parse import quote
+
+import geopandas as gpd
+import pandas as pd
+import pyogrio
+from pyproj import CRS
+
+from Memo_Cache import file_identity, make_key
+
+row_group_size = 2000  # admin units per row group, the unit of the bbox filtering
+sidecar_extensions = (".dbf", ".prj", ".cpg")  # attributes, CRS and encoding of a shapefile
+
+
+class Admin_Store:
+    """
+    Admin units shapefile (GADM, OECD) converted once into GeoParquet partitioned by
+    partition_col (GID_0, iso3): <root>/<name>_<key>/crs=<crs>/<partition_col>=<code>.parquet.
+    Within a partition the units are sorted along a Hilbert curve and carry a bbox column, so
+    reads filtered by code and bbox only touch the matching files and row groups. Projections
+    are computed once per CRS and stored next to the original one.
+    A new version of the shapefile or of its sidecars (size or modification time) gets a new
+    store.
+    """
+
+    def __init__(self, source: str, root: str, partition_col="GID_0", crss=()):
+        self.source = source
+        self.partition_col = partition_col
+        base = os.path.splitext(source)[0]
+        sidecars = {ext: file_identity(base + ext) for ext in sidecar_extensions if os.path.isfile(base + ext)}
+        key = make_key(
+            "admin_store", source=file_identity(source), sidecars=sidecars, partition_col=partition_col
+        )[:16]
+        self.folder = os.path.join(root, os.path.splitext(os.path.basename(source))[0] + "_" + key)
+        self._lock = threading.Lock()
+
+        manifest = os.path.join(self.folder, "manifest.json")
+        if not os.path.isfile(manifest):
+            self._build()
+        with open(manifest) as f:
+            self.manifest = json.load(f)
+        self.crs = CRS.from_user_input(self.manifest["crs"]) if self.manifest["crs"] else None
+
+        for crs in crss:
+            self._projection_folder(crs)
+
+    def _crs_folder(self, crs):
+        name = "native" if crs is None else CRS.from_user_input(crs).to_string()
+        if len(name) > 64:  # a CRS without authority code is named by its WKT
+            name = make_key("crs", wkt=name)[:16]
+        return os.path.join(self.folder, "crs=" + quote(name, safe=""))
+
+    def _write(self, gdf, folder):
+        """
+        One GeoParquet file per partition, written to a temporary folder then renamed.
+        """
+        tmp_folder = f"{folder}.{uuid.uuid4().hex}.tmp"
+        os.makedirs(tmp_folder)
+        for code, units in gdf.groupby(self.partition_col, sort=True):
+            units = units.iloc[units.hilbert_distance().argsort()]
+            units.drop(columns=self.partition_col).to_parquet(
+                os.path.join(tmp_folder, f"{self.partition_col}={quote(str(code), safe='')}.parquet"),
+                index=False,
+                write_covering_bbox=True,
+                row_group_size=row_group_size,
+            )
+        try:
+            os.replace(tmp_folder, folder)
+        except OSError:
+            shutil.rmtree(tmp_folder)  # built by another process meanwhile
+
+    def _build(self):
+        print("Converting the admin units ", self.source)
+        gdf = pyogrio.read_dataframe(self.source, use_arrow=True)
+        gdf = gdf[gdf.geometry.notna() & ~gdf.geometry.is_empty]
+        missing = gdf[self.partition_col].isna()
+        if missing.any():
+            print(f"{int(missing.sum())} admin units without {self.partition_col} are not stored.")
+            gdf = gdf[~missing]
+
+        os.makedirs(self.folder, exist_ok=True)
+        native = self._crs_folder(None)
+        if not os.path.isdir(native):
+            self._write(gdf, native)
+
+        manifest = {
+            "source": os.path.abspath(self.source),
+            "partition_col": self.partition_col,
+            "crs": gdf.crs.to_wkt() if gdf.crs is not None else None,
+            "partitions": sorted(gdf[self.partition_col].astype(str).unique().tolist()),
+        }
+        tmp_path = os.path.join(self.folder, f"manifest.json.{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, os.path.join(self.folder, "manifest.json"))
+
+    def _projection_folder(self, crs):
+        if crs is None or (self.crs is not None and CRS.from_user_input(crs) == self.crs):
+            return self._crs_folder(None)
+
+        folder = self._crs_folder(crs)
+        with self._lock:
+            if not os.path.isdir(folder):
+                print("Projecting the admin units to ", crs)
+                self._write(self.read().to_crs(crs), folder)
+        return folder
+
+    def parents(self):
+        """
+        The partition codes (e.g. the GID_0 of every country).
+        """
+        return list(self.manifest["partitions"])
+
+    def read(self, parents=None, bbox=None, crs=None, columns=None):
+        """
+        The units of the given partition codes (all by default) intersecting bbox (minx, miny,
+        maxx, maxy in crs), in crs (the shapefile one by default, projected at the first use).
+        """
+        folder = self._projection_folder(crs)
+        parents = self.parents() if parents is None else [str(code) for code in parents]
+        if columns is not None:
+            columns = [col for col in columns if col != self.partition_col]
+            columns = columns + ["geometry"] if "geometry" not in columns else columns
+
+        frames = []
+        for code in parents:
+            path = os.path.join(folder, f"{self.partition_col}={quote(code, safe='')}.parquet")
+            if not os.path.isfile(path):
+                continue
+            units = gpd.read_parquet(path, columns=columns, bbox=bbox)
+            units.insert(0, self.partition_col, code)
+            frames.append(units)
+
+        target_crs = crs if crs is not None else self.crs
+        if not frames:
+            return gpd.GeoDataFrame(columns=[self.partition_col, "geometry"], geometry="geometry", crs=target_crs)
+        return gpd.GeoDataFrame(pd.concat(frames, ignore_index=True), geometry="geometry", crs=frames[0].crs)
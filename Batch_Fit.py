@@ -0,0 +1,312 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import curve_fit
+from scipy.stats import norm
+
+from Fit_Models import models
+
+max_workers = 12
+chunk_size = 64  # regions sent at once to a worker
+grid_size = 100  # points of the confidence bands, like Fit.x1_fit
+max_band_values = 10**7  # curve values held at once while computing the bootstrap bands
+
+
+def _fit_chunk(model_name, chunk, init, bounds):
+    """
+    chunk is a list of (region, x1, x2, y) arrays. Returns a list of (region, params,
+    covariance, error).
+    """
+    model = models[model_name]
+    nb_params = len(model.param_names)
+
+    results = []
+    for region, x1, x2, y in chunk:
+        X = model.X(x1, x2)
+        try:
+            if len(y) < nb_params:
+                raise ValueError(f"{len(y)} points for {nb_params} parameters")
+            if model.linear:
+                # the Jacobian of a linear model is its design matrix
+                design = model.jacobian(X, *np.zeros(nb_params))
+                params = np.linalg.lstsq(design, y, rcond=None)[0]
+                covariance = _linear_covariance(design, y - design @ params)
+            else:
+                params, covariance = curve_fit(model.function, X, y, p0=init, bounds=bounds, jac=model.jacobian)
+            results.append((region, params, covariance, None))
+        except Exception as e:
+            results.append((region, np.full(nb_params, np.nan), np.full((nb_params, nb_params), np.nan), repr(e)))
+    return results
+
+
+def _linear_covariance(design, residuals):
+    # same estimate as curve_fit: residual variance times (J^T J)^-1
+    dof = len(residuals) - design.shape[1]
+    if dof <= 0:
+        return np.full((design.shape[1], design.shape[1]), np.inf)
+    return np.sum(residuals**2) / dof * np.linalg.pinv(design.T @ design)
+
+
+class Batch_Fit:
+    """
+    Fits one curve per region for many regions at once. long_df has one row per data point:
+    region, x1, (x2 for the two variables models) and y. The regions are fitted in chunks by a
+    pool of processes with the analytic Jacobians of Fit_Models, and the predictions and errors
+    of all the regions are then evaluated in one vectorized pass.
+    """
+
+    def __init__(self, long_df, region_col="region", x1_col="x1", x2_col="x2", y_col="y"):
+        self.region_col = region_col
+
+        df = long_df.dropna(subset=[x1_col, y_col]).sort_values(region_col, kind="stable")
+
+        self.regions, self.codes = np.unique(df[region_col].to_numpy(), return_inverse=True)
+        self.x1 = df[x1_col].to_numpy(dtype=float)
+        self.x2 = df[x2_col].to_numpy(dtype=float) if x2_col in df.columns else None
+        self.y = df[y_col].to_numpy(dtype=float)
+
+        # rows of each region, contiguous since the table is sorted
+        self.starts = np.searchsorted(self.codes, np.arange(len(self.regions)))
+        self.stops = np.append(self.starts[1:], len(self.codes))
+
+        # covariance matrices of the parameters of the last fit, one per region
+        self.covariances = None
+
+    def _task(self, region, rows):
+        return (region, self.x1[rows], self.x2[rows] if self.x2 is not None else None, self.y[rows])
+
+    def _run(self, model_name, tasks, init, bounds, max_workers, chunk_size):
+        """
+        Fits the (name, x1, x2, y) tasks by chunks, in a pool of processes if max_workers > 1.
+        """
+        model = models[model_name]
+        init = model.init if init is None else init
+        bounds = model.bounds if bounds is None else bounds
+        if bounds is None:
+            bounds = (-np.inf, np.inf)
+
+        chunks = [tasks[i:i + chunk_size] for i in range(0, len(tasks), chunk_size)]
+        results = []
+        if max_workers <= 1:
+            for chunk in chunks:
+                results.extend(_fit_chunk(model_name, chunk, init, bounds))
+        elif chunks:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                for chunk_results in executor.map(
+                    _fit_chunk,
+                    [model_name] * len(chunks),
+                    chunks,
+                    [init] * len(chunks),
+                    [bounds] * len(chunks),
+                ):
+                    results.extend(chunk_results)
+        return results
+
+    def _check(self, model_name):
+        if models[model_name].two_variables and (self.x2 is None or np.isnan(self.x2).any()):
+            print(f"The {model_name} model needs a x2 value for every point.")
+            return False
+        return True
+
+    def fit(self, model_name: str, init=None, bounds=None, max_workers=max_workers, chunk_size=chunk_size):
+        """
+        Returns one row per region: the fitted parameters, the error message if the fit failed,
+        the number of points, mse, rmse, r_squared and the standard error of every parameter.
+        The covariance matrices of the parameters are kept in covariances.
+        """
+        model = models[model_name]
+        if not self._check(model_name):
+            return None
+
+        tasks = [self._task(region, slice(start, stop)) for region, start, stop in zip(self.regions, self.starts, self.stops)]
+        results = self._run(model_name, tasks, init, bounds, max_workers, chunk_size)
+
+        nb_params = len(model.param_names)
+        params = np.vstack([p for _, p, _, _ in results]) if results else np.empty((0, nb_params))
+        self.covariances = np.stack([c for _, _, c, _ in results]) if results else np.empty((0, nb_params, nb_params))
+        errors = [e for _, _, _, e in results]
+
+        table = pd.DataFrame(params, columns=model.param_names)
+        table.insert(0, self.region_col, self.regions)
+        table.insert(1, "model", model_name)
+        table.insert(2, "success", [e is None for e in errors])
+        table.insert(3, "error", errors)
+        table["n_points"] = self.stops - self.starts
+
+        mse, r_squared = self._metrics(model, params)
+        table["mse"] = mse
+        table["rmse"] = np.sqrt(mse)
+        table["r_squared"] = r_squared
+        with np.errstate(invalid="ignore"):
+            stds = np.sqrt(np.diagonal(self.covariances, axis1=1, axis2=2))
+        for j, name in enumerate(model.param_names):
+            table[name + "_std"] = stds[:, j]
+
+        for region, error in zip(self.regions, errors):
+            if error is not None:
+                print("The fit failed for ", region, error)
+
+        return table
+
+    def predict(self, model_name: str, params):
+        """
+        Predictions at every data point, params holding one row of parameters per region.
+        """
+        model = models[model_name]
+        row_params = np.asarray(params, dtype=float)[self.codes]
+        return model.function(model.X(self.x1, self.x2), *row_params.T)
+
+    def _metrics(self, model, params):
+        nb_regions = len(self.regions)
+        counts = np.bincount(self.codes, minlength=nb_regions)
+
+        residuals = self.y - self.predict(model.name, params)
+        ss_res = np.bincount(self.codes, weights=residuals**2, minlength=nb_regions)
+
+        means = np.bincount(self.codes, weights=self.y, minlength=nb_regions) / np.maximum(counts, 1)
+        ss_tot = np.bincount(self.codes, weights=(self.y - means[self.codes]) ** 2, minlength=nb_regions)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mse = ss_res / counts
+            r_squared = 1 - ss_res / ss_tot
+        return mse, r_squared
+
+    def _grids(self):
+        """
+        x1 (and x2) grids of every region, shape (regions, grid_size), like Fit.x1_fit.
+        """
+        def grid(values):
+            lower = np.full(len(self.regions), np.inf)
+            upper = np.full(len(self.regions), -np.inf)
+            np.minimum.at(lower, self.codes, values)
+            np.maximum.at(upper, self.codes, values)
+            return lower[:, None] + (upper - lower)[:, None] * np.linspace(0, 1, grid_size)
+
+        return grid(self.x1), grid(self.x2) if self.x2 is not None else None
+
+    def _band_table(self, model, x1_grid, x2_grid, y_fit, lower, upper, regions):
+        table = pd.DataFrame(
+            {
+                self.region_col: np.repeat(regions, x1_grid.shape[1]),
+                "x1": x1_grid.ravel(),
+                "y_fit": y_fit.ravel(),
+                "lower": lower.ravel(),
+                "upper": upper.ravel(),
+            }
+        )
+        if model.two_variables:
+            table.insert(2, "x2", x2_grid.ravel())
+        return table
+
+    def parametric_bands(self, model_name: str, params, level=0.95):
+        """
+        Confidence bands of the fitted curves from the covariances of the last fit (delta
+        method), params holding one row of parameters per region. Returns one row per region
+        and grid point: x1, (x2), y_fit, lower and upper.
+        """
+        model = models[model_name]
+        params = np.asarray(params, dtype=float)
+        x1_grid, x2_grid = self._grids()
+        nb_regions, nb_grid = x1_grid.shape
+
+        # all the regions and grid points at once, with the parameters repeated per point
+        row_params = np.repeat(params, nb_grid, axis=0)
+        X = model.X(x1_grid.ravel(), x2_grid.ravel() if x2_grid is not None else None)
+        y_fit = model.function(X, *row_params.T).reshape(nb_regions, nb_grid)
+        jac = model.jacobian(X, *row_params.T).reshape(nb_regions, nb_grid, -1)
+
+        variance = np.einsum("rgp,rpq,rgq->rg", jac, self.covariances, jac)
+        half_width = norm.ppf(0.5 + level / 2) * np.sqrt(np.maximum(variance, 0))
+        return self._band_table(model, x1_grid, x2_grid, y_fit, y_fit - half_width, y_fit + half_width, self.regions)
+
+    def _bootstrap_bands(self, model, samples, x1_grid, x2_grid, level):
+        """
+        Quantiles of the curves of the bootstrap samples (replicates, curves, params), computed
+        by blocks of curves to bound the memory.
+        """
+        nb_boot, nb_curves, _ = samples.shape
+        nb_grid = x1_grid.shape[1]
+        block = max(1, max_band_values // (nb_boot * nb_grid))
+
+        lower = np.empty((nb_curves, nb_grid))
+        upper = np.empty((nb_curves, nb_grid))
+        for start in range(0, nb_curves, block):
+            stop = min(start + block, nb_curves)
+            X = model.X(x1_grid[None, start:stop], x2_grid[None, start:stop] if x2_grid is not None else None)
+            values = model.function(X, *[samples[:, start:stop, j, None] for j in range(samples.shape[2])])
+            lower[start:stop], upper[start:stop] = np.nanquantile(values, [0.5 - level / 2, 0.5 + level / 2], axis=0)
+        return lower, upper
+
+    def _params_table(self, model, names, params, samples, level):
+        rows = []
+        for i, name in enumerate(names):
+            for j, param in enumerate(model.param_names):
+                values = samples[:, i, j]
+                values = values[np.isfinite(values)]
+                rows.append(
+                    {
+                        self.region_col: name,
+                        "param": param,
+                        "estimate": params[i, j],
+                        "std": values.std(ddof=1) if len(values) > 1 else np.nan,
+                        "lower": np.quantile(values, 0.5 - level / 2) if len(values) else np.nan,
+                        "upper": np.quantile(values, 0.5 + level / 2) if len(values) else np.nan,
+                        "n_boot": len(values),
+                    }
+                )
+        return pd.DataFrame(rows)
+
+    def bootstrap(
+        self, model_name: str, n_boot=200, by="years", level=0.95, init=None, bounds=None,
+        max_workers=max_workers, chunk_size=chunk_size, seed=0,
+    ):
+        """
+        Nonparametric bootstrap, all the replicates being fitted by chunks in a pool of processes:
+        - by="years": the points (years) of every region are resampled, for the per-region fits;
+        - by="regions": whole regions are resampled, for one curve fitted on all the regions
+          pooled together (reported under the region name "all").
+        Returns the parameters table (estimate, bootstrap std and percentile interval of every
+        parameter) and the confidence bands table of the fitted curves.
+        """
+        model = models[model_name]
+        if not self._check(model_name):
+            return None, None
+        rng = np.random.default_rng(seed)
+        nb_params = len(model.param_names)
+
+        if by == "years":
+            names = self.regions
+            tasks = [self._task(region, slice(start, stop)) for region, start, stop in zip(self.regions, self.starts, self.stops)]
+            for b in range(n_boot):
+                for i, (start, stop) in enumerate(zip(self.starts, self.stops)):
+                    tasks.append(self._task((b, i), rng.integers(start, stop, stop - start)))
+            x1_grid, x2_grid = self._grids()
+        elif by == "regions":
+            names = np.array(["all"])
+            tasks = [self._task("all", slice(None))]
+            for b in range(n_boot):
+                picked = rng.integers(0, len(self.regions), len(self.regions))
+                rows = np.concatenate([np.arange(self.starts[i], self.stops[i]) for i in picked])
+                tasks.append(self._task((b, 0), rows))
+            x1_grid = np.linspace(self.x1.min(), self.x1.max(), grid_size)[None, :]
+            x2_grid = np.linspace(self.x2.min(), self.x2.max(), grid_size)[None, :] if self.x2 is not None else None
+        else:
+            print("Bootstrap by ", by, " not recognised, use years or regions")
+            return None, None
+
+        results = self._run(model_name, tasks, init, bounds, max_workers, chunk_size)
+
+        params = np.vstack([p for _, p, _, _ in results[: len(names)]])
+        samples = np.full((n_boot, len(names), nb_params), np.nan)
+        for (b, i), p, _, _ in results[len(names):]:
+            samples[b, i] = p
+
+        X = model.X(x1_grid.ravel(), x2_grid.ravel() if x2_grid is not None else None)
+        y_fit = model.function(X, *np.repeat(params, x1_grid.shape[1], axis=0).T).reshape(x1_grid.shape)
+        lower, upper = self._bootstrap_bands(model, samples, x1_grid, x2_grid, level)
+
+        return (
+            self._params_table(model, names, params, samples, level),
+            self._band_table(model, x1_grid, x2_grid, y_fit, lower, upper, names),
+        )
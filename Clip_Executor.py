@@ -0,0 +1,250 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import rasterio
+import shapely
+from rasterio.errors import WindowError
+from rasterio.features import geometry_window
+from rasterio.mask import mask
+from rasterio.windows import Window
+
+from Memo_Cache import file_identity
+
+max_workers = 12
+batch_size = 16  # geometries sent at once to a worker
+# a multipolygon is clipped part by part when the windows of its parts cover less than this
+# fraction of its bounding window (overseas territories, islands, antimeridian)
+max_parts_fill = 0.5
+tile_size = 256  # blocks of the sparse outputs
+
+# dataset opened once per worker process of the pool, see _init_worker
+_src = None
+
+
+def _part_windows(src, parts):
+    """
+    Window of every part overlapping the raster.
+    """
+    windows = []
+    for part in parts:
+        try:
+            windows.append((part, geometry_window(src, [part])))
+        except WindowError:
+            pass  # outside the raster
+    return windows
+
+
+def clip_parts(src, part_windows, window, output_file):
+    """
+    Clips the opened raster along the parts of a multipolygon into a tiled, sparse GeoTIFF
+    covering window: only the window of every part is read and written, the blocks that no
+    part touches are not stored and read as nodata.
+    """
+    nodata = src.nodata if src.nodata is not None else 0
+    out_meta = src.meta.copy()
+    out_meta.update(
+        {
+            "driver": "GTiff",
+            "height": int(window.height),
+            "width": int(window.width),
+            "transform": src.window_transform(window),
+            "nodata": nodata,
+            "compress": "lzw",
+            "tiled": True,
+            "blockxsize": tile_size,
+            "blockysize": tile_size,
+            "sparse_ok": True,
+        }
+    )
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    with rasterio.open(output_file, "w+", **out_meta) as dest:
+        for part, _ in part_windows:
+            part_image, part_transform = mask(src, [part], crop=True, nodata=nodata, filled=False)
+            # the part window relative to the output
+            out_window = Window(
+                round((part_transform.c - dest.transform.c) / dest.transform.a),
+                round((part_transform.f - dest.transform.f) / dest.transform.e),
+                part_image.shape[2],
+                part_image.shape[1],
+            )
+            # parts with overlapping windows (an island in a bay) keep each other's pixels
+            inside = ~np.ma.getmaskarray(part_image)
+            current = dest.read(window=out_window)
+            dest.write(np.where(inside, part_image.data, current), window=out_window)
+
+    return output_file
+
+
+def clip_geometry(src, geometry, output_file):
+    """
+    Clips the opened raster along one geometry (in the raster CRS) and saves it as a LZW GeoTIFF.
+    Scattered multipolygons are clipped part by part (see clip_parts).
+    """
+    parts = shapely.get_parts(geometry)
+    if len(parts) > 1:
+        window = geometry_window(src, [geometry])
+        part_windows = _part_windows(src, parts)
+        parts_area = sum(float(w.width) * float(w.height) for _, w in part_windows)
+        if parts_area < max_parts_fill * float(window.width) * float(window.height):
+            return clip_parts(src, part_windows, window, output_file)
+
+    out_image, out_transform = mask(src, [geometry], crop=True)
+    out_meta = src.meta.copy()
+
+    # Update the metadata with new dimensions, transform, and CRS
+    out_meta.update(
+        {
+            "driver": "GTiff",
+            "height": out_image.shape[1],
+            "width": out_image.shape[2],
+            "transform": out_transform,
+            "dtype": out_image.dtype,
+            "compress": "lzw",  # lossless compression algorithm
+        }
+    )
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    with rasterio.open(output_file, "w", **out_meta) as dest:
+        dest.write(out_image)
+
+    return output_file
+
+
+def _init_worker(raster_file):
+    global _src
+    _src = rasterio.open(raster_file)
+
+
+def _clip_batch_worker(batch):
+    return _clip_batch(_src, batch)
+
+
+def _clip_batch(src, batch):
+    """
+    batch is a list of (name, output_file, geometry as WKB), clipped from the opened src.
+    """
+    results = []
+    for name, output_file, geometry_wkb in batch:
+        start = time.perf_counter()
+        error = None
+        try:
+            clip_geometry(src, shapely.from_wkb(geometry_wkb), output_file)
+        except Exception as e:
+            error = repr(e)
+
+        results.append(
+            {
+                "name": name,
+                "file": output_file,
+                "status": "failed" if error else "done",
+                "seconds": time.perf_counter() - start,
+                "error": error,
+            }
+        )
+    return results
+
+
+class Clip_Executor:
+    """
+    Clips one global raster along many geometries. The tasks are sent in WKB batches to a
+    pool of processes, each of them opening the global raster only once. With max_workers=1
+    everything runs in the current process.
+    With a Memo_Cache, an existing output is only reused if it was clipped from the same raster
+    file along the same geometry; otherwise only its existence is checked.
+    """
+
+    def __init__(self, raster_file, max_workers=max_workers, batch_size=batch_size, overwrite=False, memo_cache=None):
+        self.raster_file = raster_file
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.overwrite = overwrite
+        self.memo_cache = memo_cache
+        self._raster_identity = None  # read at the first cache key
+
+    def _key(self, output_file, geometry):
+        if self.memo_cache is None:
+            return None
+        if self._raster_identity is None:
+            self._raster_identity = file_identity(self.raster_file)
+        return self.memo_cache.key("clip", raster=self._raster_identity, geometry=geometry, output=output_file)
+
+    def _is_up_to_date(self, output_file, key):
+        if not os.path.isfile(output_file):
+            return False
+        if self.memo_cache is None:
+            return True
+        return self.memo_cache.get(key) == file_identity(output_file)
+
+    def is_up_to_date(self, output_file, geometry):
+        """
+        Whether the output would be skipped by run: it exists and, with a memo_cache, was
+        clipped from the same raster along the same geometry (False with overwrite).
+        """
+        return not self.overwrite and self._is_up_to_date(output_file, self._key(output_file, geometry))
+
+    def run(self, tasks):
+        """
+        tasks is an iterable of (name, output_file, geometry), the geometries being in the
+        raster CRS. Returns a report with one row per task: status (done, skipped or failed),
+        time spent and error.
+        """
+        keys = {}
+
+        report = []
+        todo = []
+        for name, output_file, geometry in tasks:
+            if self.memo_cache is not None:
+                keys[output_file] = self._key(output_file, geometry)
+
+            if not self.overwrite and self._is_up_to_date(output_file, keys.get(output_file)):
+                report.append({"name": name, "file": output_file, "status": "skipped", "seconds": 0.0, "error": None})
+            else:
+                todo.append((name, output_file, shapely.to_wkb(geometry)))
+
+        batches = [todo[i:i + self.batch_size] for i in range(0, len(todo), self.batch_size)]
+
+        if self.max_workers <= 1 and batches:
+            # a dataset of its own, runs from several threads must not share one
+            with rasterio.open(self.raster_file) as src:
+                for batch in batches:
+                    report.extend(_clip_batch(src, batch))
+        elif batches:
+            with ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                initializer=_init_worker,
+                initargs=(self.raster_file,),
+            ) as executor:
+                futures = [executor.submit(_clip_batch_worker, batch) for batch in batches]
+                for future in as_completed(futures):
+                    report.extend(future.result())
+
+        report = pd.DataFrame(report, columns=["name", "file", "status", "seconds", "error"])
+        if self.memo_cache is not None:
+            for output_file in report.loc[report["status"] == "done", "file"]:
+                self.memo_cache.put(keys[output_file], file_identity(output_file))
+
+        for _, row in report.loc[report["status"] == "failed"].iterrows():
+            print("Something went wrong while trying to cut a raster for\n", row["name"], row["error"])
+
+        return report
+
+    def run_gdf(self, gpd_admin_units, region_col: str, output_folder: str):
+        """
+        Clips the raster along every admin unit, saved as <output_folder>/<region>.tif.
+        """
+        with rasterio.open(self.raster_file) as src:
+            crs = src.crs
+
+        admin_units = gpd_admin_units[~gpd_admin_units.geometry.isnull()]
+        if admin_units.crs != crs:
+            print("Reshaping the admin units file to the same src CRS")
+            admin_units = admin_units.to_crs(crs)
+
+        return self.run(
+            (name, os.path.join(output_folder, f"{name}.tif"), geometry)
+            for name, geometry in zip(admin_units[region_col], admin_units.geometry)
+        )
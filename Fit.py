@@ -1,6 +1,9 @@
 from scipy.optimize import curve_fit
+from scipy.stats import norm
 import numpy as np
 
+import Fit_Models
+
 class Fit:
     def __init__(self, name, x1, x2, y):
         self.name = name
@@ -21,8 +24,15 @@ class Fit:
 
         self.y_fit = []
 
+        # covariance of the fitted parameters and confidence band of y_fit, see confidence_band
+        self.model_name = None
+        self.covariance = None
+        self.y_fit_lower = []
+        self.y_fit_upper = []
+
     def fit_linear_regression(self):
-        popt, _ = curve_fit(self._linear_objective, self.x1, self.y)
+        self.model_name = "linear"
+        popt, self.covariance = curve_fit(self._linear_objective, self.x1, self.y, jac=Fit_Models.linear_jacobian)
         for param in popt:
             self.fitted_params.append(param)
 
@@ -36,7 +46,10 @@ class Fit:
         self._compute_errors()
 
     def fit_double_linear_regression(self):
-        popt, _ = curve_fit(self._double_linear_objective, [self.x1, self.x2], self.y)
+        self.model_name = "double_linear"
+        popt, self.covariance = curve_fit(
+            self._double_linear_objective, [self.x1, self.x2], self.y, jac=Fit_Models.double_linear_jacobian
+        )
         for param in popt:
             self.fitted_params.append(param)
 
@@ -60,8 +73,9 @@ class Fit:
         init=[1, 1, 1, 1, 1],
         bounds=([0, 0, 0, 0, 0], [600, 10000, 100, 1, 60000]),
     ):
-        popt, _ = curve_fit(
-            self._STL_objective, [self.x1, self.x2], self.y, p0=init, bounds=bounds
+        self.model_name = "STL"
+        popt, self.covariance = curve_fit(
+            self._STL_objective, [self.x1, self.x2], self.y, p0=init, bounds=bounds, jac=Fit_Models.STL_jacobian
         )
         for param in popt:
             self.fitted_params.append(param)
@@ -86,8 +100,9 @@ class Fit:
         self._compute_errors()
 
     def fit_logistic(self, init=[1, 1, 1], bounds=([0, 0, 0], [600, 1, 100000])):
-        popt, _ = curve_fit(
-            self._logistic_objective, self.x1, self.y, p0=init, bounds=bounds
+        self.model_name = "logistic"
+        popt, self.covariance = curve_fit(
+            self._logistic_objective, self.x1, self.y, p0=init, bounds=bounds, jac=Fit_Models.logistic_jacobian
         )
         for param in popt:
             self.fitted_params.append(param)
@@ -110,8 +125,14 @@ class Fit:
     def fit_exponential_decay_bias(
         self, init=[1, 1, 1], bounds=([0, 0, 0], [1000, 10000, 1000])
     ):
-        popt, _ = curve_fit(
-            self._exponential_decay_objective_bias, self.x1, self.y, p0=init, bounds=bounds
+        self.model_name = "exponential_decay_bias"
+        popt, self.covariance = curve_fit(
+            self._exponential_decay_objective_bias,
+            self.x1,
+            self.y,
+            p0=init,
+            bounds=bounds,
+            jac=Fit_Models.exponential_decay_bias_jacobian,
         )
         for param in popt:
             self.fitted_params.append(param)
@@ -132,12 +153,14 @@ class Fit:
         self._compute_errors()
 
     def fit_exponential_decay(self, init=[1, 1], bounds=([0, 0], [1000, 10000])):
-        popt, _ = curve_fit(
+        self.model_name = "exponential_decay"
+        popt, self.covariance = curve_fit(
             self._exponential_decay_objective,
             self.x1,
             self.y,
             p0=init,
             bounds=bounds,
+            jac=Fit_Models.exponential_decay_jacobian,
         )
         for param in popt:
             self.fitted_params.append(param)
@@ -156,8 +179,9 @@ class Fit:
         self._compute_errors()
 
     def fit_reciprocal(self, init=[1, 10], bounds=([0, 0], [10, 1000])):
-        popt, _ = curve_fit(
-            self._reciprocal_objective, self.x1, self.y, p0=init, bounds=bounds
+        self.model_name = "reciprocal"
+        popt, self.covariance = curve_fit(
+            self._reciprocal_objective, self.x1, self.y, p0=init, bounds=bounds, jac=Fit_Models.reciprocal_jacobian
         )
         for param in popt:
             self.fitted_params.append(param)
@@ -175,26 +199,40 @@ class Fit:
 
         self._compute_errors()
 
+    def confidence_band(self, level=0.95):
+        """
+        Confidence band of y_fit from the covariance of the fitted parameters (delta method).
+        """
+        model = Fit_Models.models[self.model_name]
+        X = model.X(self.x1_fit, self.x2_fit)
+        jac = model.jacobian(X, *self.fitted_params)
+        variance = np.einsum("gp,pq,gq->g", jac, self.covariance, jac)
+        half_width = norm.ppf(0.5 + level / 2) * np.sqrt(np.maximum(variance, 0))
+
+        self.y_fit_lower = self.y_fit - half_width
+        self.y_fit_upper = self.y_fit + half_width
+        return self.y_fit_lower, self.y_fit_upper
+
     def _STL_objective(self, X, a, b, c, d, e):
-        pib_per_cap, rho = X
-        saturation = self._exponential_decay_objective_bias(rho, a, b, c)
-        return saturation / (1 + np.exp(-d * (pib_per_cap - e)))
+        return Fit_Models.STL(X, a, b, c, d, e)
 
     def _logistic_objective(self, X, a, b, c):
-        return a / (1 + np.exp(-b * (X - c)))
+        return Fit_Models.logistic(X, a, b, c)
 
     def _exponential_decay_objective_bias(self, X, a, b, c):
-        return a * np.exp(-b * X) + c
+        return Fit_Models.exponential_decay_bias(X, a, b, c)
 
     def _exponential_decay_objective(self, X, a, b):
-        return a * np.exp(-b * X)
+        return Fit_Models.exponential_decay(X, a, b)
+
+    def _reciprocal_objective(self, X, a, b):
+        return Fit_Models.reciprocal(X, a, b)
 
     def _linear_objective(self, x1, a, b):
-        return a * x1 + b
+        return Fit_Models.linear(x1, a, b)
 
     def _double_linear_objective(self, X, a0, a1, a2):
-        x1, x2 = X
-        return a0 * x1 + a1 * x2 + a2
+        return Fit_Models.double_linear(X, a0, a1, a2)
 
     def _compute_errors(self):
         self._compute_rmse()
@@ -1,4 +1,9 @@
+import numpy as np
+import pandas as pd
+
+from Batch_Fit import Batch_Fit, max_workers
 from Fit import Fit
+from Fit_Models import models
 
 
 class Fit_Handler:
@@ -6,6 +11,36 @@ class Fit_Handler:
         self.name = name
         self.fits = []
 
-    def add_fit(self, name: str, x, y):
-        fit = Fit(name, x, y)
+    def add_fit(self, name: str, x1, x2, y):
+        fit = Fit(name, x1, x2, y)
         self.fits.append(fit)
+
+    def fit_all(self, model_name: str, init=None, bounds=None, max_workers=max_workers):
+        """
+        Fits the same model on all the fits at once with Batch_Fit, fills their fitted_params,
+        covariance, y_pred, y_fit and errors, and returns the parameters and errors table.
+        """
+        model = models[model_name]
+        long_df = pd.concat(
+            [
+                pd.DataFrame({"region": i, "x1": fit.x1, "y": fit.y, **({"x2": fit.x2} if model.two_variables else {})})
+                for i, fit in enumerate(self.fits)
+            ],
+            ignore_index=True,
+        )
+        batch_fit = Batch_Fit(long_df)
+        table = batch_fit.fit(model_name, init=init, bounds=bounds, max_workers=max_workers)
+        if table is None:
+            return None
+
+        for i, params, covariance in zip(table["region"], table[model.param_names].to_numpy(), batch_fit.covariances):
+            fit = self.fits[i]
+            fit.model_name = model_name
+            fit.covariance = covariance
+            fit.fitted_params = list(params)
+            fit.y_pred = model.function(model.X(np.asarray(fit.x1, dtype=float), np.asarray(fit.x2, dtype=float)), *params)
+            fit.y_fit = model.function(model.X(fit.x1_fit, fit.x2_fit), *params)
+            fit._compute_errors()
+
+        table.insert(1, "name", [self.fits[i].name for i in table["region"]])
+        return table.drop(columns="region")
@@ -0,0 +1,151 @@
+import numpy as np
+from scipy.special import expit
+
+# Curves fitted by Fit and Batch_Fit, with their analytic Jacobians.
+# The functions follow the curve_fit convention f(X, *params), X being x1 or [x1, x2],
+# and the Jacobians return an array of shape (number of points, number of params).
+
+
+def logistic(X, a, b, c):
+    return a * expit(b * (X - c))
+
+
+def logistic_partials(X, a, b, c):
+    """
+    Partial derivatives with respect to a, b and c, broadcast like logistic.
+    """
+    X = np.asarray(X, dtype=float)
+    s = expit(b * (X - c))
+    ds = s * (1 - s)
+    return s, a * ds * (X - c), -a * b * ds
+
+
+def logistic_second_partials(X, a, b, c):
+    """
+    Second derivatives (aa, ab, ac, bb, bc, cc), broadcast like logistic.
+    """
+    X = np.asarray(X, dtype=float)
+    u = X - c
+    s = expit(b * u)
+    ds = s * (1 - s)
+    d2s = ds * (1 - 2 * s)
+    zeros = np.zeros_like(s)
+    return zeros, ds * u, -b * ds, a * d2s * u**2, -a * (b * u * d2s + ds), a * b**2 * d2s
+
+
+def logistic_jacobian(X, a, b, c):
+    return np.column_stack(logistic_partials(X, a, b, c))
+
+
+def exponential_decay_bias(X, a, b, c):
+    return a * np.exp(-b * X) + c
+
+
+def exponential_decay_bias_jacobian(X, a, b, c):
+    X = np.asarray(X, dtype=float)
+    e = np.exp(-b * X)
+    return np.column_stack([e, -a * X * e, np.ones_like(X)])
+
+
+def exponential_decay(X, a, b):
+    return a * np.exp(-b * X)
+
+
+def exponential_decay_jacobian(X, a, b):
+    X = np.asarray(X, dtype=float)
+    e = np.exp(-b * X)
+    return np.column_stack([e, -a * X * e])
+
+
+def reciprocal(X, a, b):
+    return a + b / X
+
+
+def reciprocal_jacobian(X, a, b):
+    X = np.asarray(X, dtype=float)
+    return np.column_stack([np.ones_like(X), 1 / X])
+
+
+def STL(X, a, b, c, d, e):
+    pib_per_cap, rho = X
+    saturation = exponential_decay_bias(rho, a, b, c)
+    return saturation * expit(d * (pib_per_cap - e))
+
+
+def STL_jacobian(X, a, b, c, d, e):
+    pib_per_cap, rho = (np.asarray(x, dtype=float) for x in X)
+    decay = np.exp(-b * rho)
+    saturation = a * decay + c
+    s = expit(d * (pib_per_cap - e))
+    ds = s * (1 - s)
+    return np.column_stack(
+        [decay * s, -a * rho * decay * s, s, saturation * ds * (pib_per_cap - e), -saturation * ds * d]
+    )
+
+
+def linear(X, a, b):
+    return a * X + b
+
+
+def linear_jacobian(X, a, b):
+    X = np.asarray(X, dtype=float)
+    return np.column_stack([X, np.ones_like(X)])
+
+
+def double_linear(X, a0, a1, a2):
+    x1, x2 = X
+    return a0 * x1 + a1 * x2 + a2
+
+
+def double_linear_jacobian(X, a0, a1, a2):
+    x1, x2 = (np.asarray(x, dtype=float) for x in X)
+    return np.column_stack([x1, x2, np.ones_like(x1)])
+
+
+class Fit_Model:
+    """
+    A curve with its Jacobian, parameter names, default initial guess and bounds.
+    Linear models are solved directly by least squares.
+    """
+
+    def __init__(self, name, function, jacobian, param_names, init=None, bounds=None, two_variables=False, linear=False):
+        self.name = name
+        self.function = function
+        self.jacobian = jacobian
+        self.param_names = list(param_names)
+        self.init = init
+        self.bounds = bounds
+        self.two_variables = two_variables
+        self.linear = linear
+
+    def X(self, x1, x2=None):
+        return [x1, x2] if self.two_variables else x1
+
+
+# same defaults as the Fit.fit_* methods
+models = {
+    "logistic": Fit_Model(
+        "logistic", logistic, logistic_jacobian, ["a", "b", "c"],
+        init=[1, 1, 1], bounds=([0, 0, 0], [600, 1, 100000]),
+    ),
+    "STL": Fit_Model(
+        "STL", STL, STL_jacobian, ["a", "b", "c", "d", "e"],
+        init=[1, 1, 1, 1, 1], bounds=([0, 0, 0, 0, 0], [600, 10000, 100, 1, 60000]), two_variables=True,
+    ),
+    "exponential_decay_bias": Fit_Model(
+        "exponential_decay_bias", exponential_decay_bias, exponential_decay_bias_jacobian, ["a", "b", "c"],
+        init=[1, 1, 1], bounds=([0, 0, 0], [1000, 10000, 1000]),
+    ),
+    "exponential_decay": Fit_Model(
+        "exponential_decay", exponential_decay, exponential_decay_jacobian, ["a", "b"],
+        init=[1, 1], bounds=([0, 0], [1000, 10000]),
+    ),
+    "reciprocal": Fit_Model(
+        "reciprocal", reciprocal, reciprocal_jacobian, ["a", "b"],
+        init=[1, 10], bounds=([0, 0], [10, 1000]),
+    ),
+    "linear": Fit_Model("linear", linear, linear_jacobian, ["a", "b"], linear=True),
+    "double_linear": Fit_Model(
+        "double_linear", double_linear, double_linear_jacobian, ["a0", "a1", "a2"], two_variables=True, linear=True
+    ),
+}
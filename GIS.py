@@ -25,7 +25,5 @@ class GIS(ABC):
     #     self.observables.append(obs)
 
     @abstractmethod
-    def make_mask(
-        self, region_name: str, region_col_name: str, parent_name: str, overwrite=False
-    ):
+    def make_mask(self, geometry, region_name: str, parent_name: str, overwrite=False):
         pass
@@ -1,11 +1,12 @@
 from GIS import GIS
+from Clip_Executor import Clip_Executor
+from Raster_Windows import accumulator_dtype, iter_windows, max_window_memory
+from Zonal_Stats import Zonal_Stats
 
 import os
 import sys
+import numpy as np
 import rasterio
-from rasterio.mask import mask
-import geopandas as gpd
-from shapely.geometry import mapping
 
 
 class GIS_Raster(GIS):
@@ -18,6 +19,7 @@ class GIS_Raster(GIS):
                 self.type = "raster"
                 self.year = year
                 self.lvl = lvl
+                self.crs = None  # read from the file at the first get_crs
             else:
                 print(
                     "The file: ", file, " seems to be neither a raster. Please check the given file."
@@ -27,96 +29,58 @@ class GIS_Raster(GIS):
             print("The file: ", file, " does not exists. Check the path.")
             sys.exit()
 
-    def make_mask(
-        self,
-        shapefile,
-        region_name: str,
-        region_col_name: str,
-        parent_name: str,
-        overwrite=False,
-    ):
+    def get_crs(self):
+        if self.crs is None:
+            with rasterio.open(self.file) as src:
+                self.crs = src.crs
+        return self.crs
 
-        # Read the raster file
-        with rasterio.open(self.file) as src:
-            for index, row in shapefile.iterrows():
-                if row[region_col_name] == region_name:
-                    # Define the output raster path
-                    subregions_file = os.path.join(
-                        os.path.dirname(self.file),
-                        os.path.join(parent_name, "subregions"),
-                        f"{region_name}.tif",
-                    )
-                    os.makedirs(os.path.dirname(subregions_file), exist_ok=True)
+    def make_mask(self, geometry, region_name: str, parent_name: str, overwrite=False, memo_cache=None):
+        """
+        geometry must be in the raster CRS (see get_crs), e.g. from Admin_Index.geometry.
+        """
+        # Define the output raster path
+        subregions_file = os.path.join(
+            os.path.dirname(self.file),
+            os.path.join(parent_name, "subregions"),
+            f"{region_name}.tif",
+        )
 
-                    # check if the file already exists
-                    if not os.path.isfile(subregions_file) or overwrite:
-                        # Ensure the shapefile geometry is in the same coordinate system as the raster
-                        if shapefile.crs != src.crs:
-                            print(
-                                "Warning the CRS do not match! The code below is not working for now"
-                            )
-                            shapefile = shapefile.to_crs(src.crs)
-                            shape = [
-                                mapping(
-                                    shapefile.loc[
-                                        shapefile[region_col_name] == region_name
-                                    ].geometry
-                                )
-                            ]
-                        else:
-                            shape = [mapping(row.geometry)]
+        report = Clip_Executor(self.file, max_workers=1, overwrite=overwrite, memo_cache=memo_cache).run(
+            [(region_name, subregions_file, geometry)]
+        )
+        if (report["status"] == "failed").any():
+            return
 
-                        try:
-                            # Mask the raster with the individual shape
-                            out_image, out_transform = mask(src, shape, crop=True)
-                            out_meta = src.meta.copy()
+        if (report["status"] == "done").any():
+            print("Saved a new tif:\n", subregions_file)
+        return subregions_file
 
-                            # Update the metadata with new dimensions, transform, and CRS
-                            out_meta.update(
-                                {
-                                    "driver": "GTiff",
-                                    "height": out_image.shape[1],
-                                    "width": out_image.shape[2],
-                                    "transform": out_transform,
-                                    "dtype": out_image.dtype,
-                                    "compress": "lzw",  # lossless compression algorithm
-                                }
-                            )
+    def get_zonal_stats(self, gpd_admin_units, region_col: str, band=1, memo_cache=None):
+        """
+        Sum, valid pixel count, mean, min and max of the raster for every admin unit,
+        computed in one pass without cutting a raster per region.
+        """
+        return Zonal_Stats(gpd_admin_units, region_col).compute(self.file, band=band, memo_cache=memo_cache)
 
-                            # Save the clipped raster to a new file
-                            with rasterio.open(
-                                subregions_file, "w", **out_meta
-                            ) as dest:
-                                dest.write(out_image)
-                                print("Saved a new tif:\n", subregions_file)
-                        except Exception as e:
-                            # print(e)
-                            print(
-                                "Something went wrong while trying to cut a raster for\n",
-                                region_name,
-                                e,
-                            )
-                            return
+    def get_pixel_stats(self, band=1, max_memory=max_window_memory):
+        """
+        Sum and number of the valid (not nodata) pixels of a band, in one streaming pass over
+        block-aligned windows so that no more than max_memory bytes are read at once.
+        """
+        with rasterio.open(self.file) as src:
+            total = accumulator_dtype(src.dtypes[band - 1]).type(0)
+            count = 0
+            for window in iter_windows(src, band, max_memory):
+                data = src.read(band, window=window, masked=True)
+                valid = ~np.ma.getmaskarray(data)
+                total += data.data.sum(where=valid, dtype=total.dtype)
+                count += int(valid.sum())
 
-            return subregions_file
+        return total, count
 
     def get_total_sum_pixel_values(self, band=0):
-        bands = []
-        with rasterio.open(self.file) as dataset:
-            nb_bands = dataset.count
-            # Step 2: Extract the raster data
-            for _ in range(nb_bands):
-                bands.append(dataset.read(band + 1))  # Read the first band
-
-        # Flatten the array to 1D and remove any no-data values (e.g., negative or extreme values)
-        for band in bands:
-            flat_band = band.flatten()
-            flat_band = flat_band[flat_band != dataset.nodata]
-
-            return sum(flat_band)
+        return self.get_pixel_stats(band + 1)[0]
 
     def get_total_number_pixels(self):
-        with rasterio.open(self.file) as src:
-            band = src.read(1).flatten()
-            band_filtered = band[band != src.nodata]
-            return len(band_filtered) 
+        return self.get_pixel_stats()[1]
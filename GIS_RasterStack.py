@@ -0,0 +1,88 @@
+from GIS_Raster import GIS_Raster
+from Raster_Windows import accumulator_dtype, iter_windows, max_window_memory
+from Zonal_Stats import Zonal_Stats, same_grid
+
+from contextlib import ExitStack
+import numpy as np
+import pandas as pd
+import rasterio
+
+
+class GIS_RasterStack:
+    """
+    Co-registered rasters of the same region (several GHSL products and epochs on the same
+    grid). Their statistics are computed in a single windowed pass instead of one pass per raster.
+    """
+
+    def __init__(self, name: str, lvl: int):
+        self.name = name
+        self.type = "raster_stack"
+        self.level = lvl
+        self.rasters = []
+
+    def matches(self, gis: GIS_Raster):
+        """
+        Whether the raster is on the grid of the stack (always True for an empty stack).
+        """
+        if not self.rasters:
+            return True
+        with rasterio.open(self.rasters[0].file) as ref, rasterio.open(gis.file) as src:
+            return same_grid(ref, src)
+
+    def add_raster(self, gis: GIS_Raster):
+        if not self.matches(gis):
+            print("The raster ", gis.file, " is not on the grid of the stack ", self.name)
+            return False
+
+        self.rasters.append(gis)
+        return True
+
+    def get_pixel_stats(self, band=1, max_memory=max_window_memory):
+        """
+        Sum and number of valid pixels of every raster of the stack, as one DataFrame with a
+        row per raster.
+        """
+        if not self.rasters:
+            return pd.DataFrame(columns=["gis", "year", "sum", "count"])
+
+        with ExitStack() as stack:
+            sources = [stack.enter_context(rasterio.open(gis.file)) for gis in self.rasters]
+            totals = [accumulator_dtype(src.dtypes[band - 1]).type(0) for src in sources]
+            counts = [0 for _ in sources]
+
+            bytes_per_pixel = sum(np.dtype(src.dtypes[band - 1]).itemsize + 1 for src in sources)
+            for window in iter_windows(sources[0], band, max_memory, bytes_per_pixel):
+                for k, src in enumerate(sources):
+                    data = src.read(band, window=window, masked=True)
+                    valid = ~np.ma.getmaskarray(data)
+                    totals[k] += data.data.sum(where=valid, dtype=totals[k].dtype)
+                    counts[k] += int(valid.sum())
+
+        return pd.DataFrame(
+            {
+                "gis": [gis.name for gis in self.rasters],
+                "year": [gis.year for gis in self.rasters],
+                "sum": totals,
+                "count": counts,
+            }
+        )
+
+    def get_zonal_stats(self, gpd_admin_units, region_col: str, band=1, max_memory=max_window_memory, memo_cache=None):
+        """
+        Zonal statistics of every raster of the stack for every admin unit. Returns one
+        DataFrame with a row per (admin unit, gis).
+        """
+        if not self.rasters:
+            return pd.DataFrame(columns=[region_col, "gis", "year", "sum", "count", "mean", "min", "max"])
+
+        stats_list = Zonal_Stats(gpd_admin_units, region_col).compute_many(
+            [gis.file for gis in self.rasters], band=band, max_memory=max_memory, memo_cache=memo_cache
+        )
+        if stats_list is None:
+            return None
+
+        for gis, stats in zip(self.rasters, stats_list):
+            stats.insert(1, "gis", gis.name)
+            stats.insert(2, "year", gis.year)
+
+        return pd.concat(stats_list, ignore_index=True)
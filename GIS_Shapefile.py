@@ -23,5 +23,5 @@ class GIS_Shapefile(GIS):
             print("The file: ", file, " does not exists. Check the path.")
             sys.exit()
 
-    def make_mask(self, shapefile, region_name: str, parent_name: str, overwrite=False):
-        return super().make_mask(shapefile, region_name, parent_name, overwrite=False)
+    def make_mask(self, geometry, region_name: str, parent_name: str, overwrite=False):
+        return super().make_mask(geometry, region_name, parent_name, overwrite=False)
@@ -0,0 +1,219 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from Batch_Fit import Batch_Fit
+from Fit_Models import logistic
+from RegionalFit import RegionalFit
+from RegionalFit_Solvers import bounds_arrays
+
+max_workers = 12
+n_parent_points = 50  # points of the parent curve the children must add up to
+
+
+def _reconcile(regional_fit, solver, options):
+    """
+    Solves one parent in a worker process. Returns (opt, violation, error), error being None
+    unless the optimization raised (or exited), in which case opt and violation are None.
+    """
+    try:
+        regional_fit.optimize(solver=solver, options=options)
+        return regional_fit.opt, regional_fit.constraint_violation(regional_fit.opt.x), None
+    except (Exception, SystemExit) as e:
+        return None, None, repr(e)
+
+
+class Hierarchical_Fit:
+    """
+    Logistic curves reconciled down a Region tree (country -> GADM_1 -> GADM_2), as built by
+    make_subregions. The roots are fitted on their own data, then level by level the children
+    of every solved parent are fitted with RegionalFit so that their curves, weighted by their
+    share of weight_col, add up to the parent curve. The parents of a level are independent
+    and solved in a pool of processes.
+    The data of a region is read from its output_df_merged: x_col, y_col (divided by
+    weight_col if y_per_weight) and weight_col, the weight being taken at the last year.
+    """
+
+    def __init__(
+        self,
+        regions,
+        x_col: str,
+        y_col: str,
+        weight_col: str,
+        year_col="year",
+        y_per_weight=False,
+        initial_guess=None,
+        bounds=None,
+        tolerance_percentage=None,
+    ):
+        self.regions = regions
+        self.x_col = x_col
+        self.y_col = y_col
+        self.weight_col = weight_col
+        self.year_col = year_col
+        self.y_per_weight = y_per_weight
+        self.tolerance_percentage = tolerance_percentage
+
+        # same defaults as RegionalFit
+        default = RegionalFit("", [0], [0])
+        self.initial_guess = initial_guess if initial_guess is not None else default.initial_guess
+        self.bounds = bounds if bounds is not None else default.bounds
+
+    def _data(self, region):
+        """
+        x, y and weight of a region, None if it has no usable data.
+        """
+        df = region.output_df_merged
+        cols = [self.x_col, self.y_col, self.weight_col]
+        if df is None or any(col not in df.columns for col in cols):
+            return None
+
+        df = df.dropna(subset=cols)
+        if df.empty:
+            return None
+        if self.year_col in df.columns:
+            df = df.sort_values(self.year_col)
+
+        x = df[self.x_col].to_numpy(dtype=float)
+        y = df[self.y_col].to_numpy(dtype=float)
+        if self.y_per_weight:
+            y = y / df[self.weight_col].to_numpy(dtype=float)
+        return x, y, float(df[self.weight_col].iloc[-1])
+
+    def _fit_level(self, nodes, data, max_workers):
+        """
+        Independent logistic fits of all the nodes of a level at once, used for the roots
+        and as warm starts of the reconciliations.
+        """
+        long_df = pd.concat(
+            [pd.DataFrame({"region": i, "x1": data[i][0], "y": data[i][1]}) for i in range(len(nodes)) if data[i]],
+            ignore_index=True,
+        )
+        lower, upper = bounds_arrays(self.bounds)
+        table = Batch_Fit(long_df).fit(
+            "logistic", init=self.initial_guess, bounds=(lower, upper), max_workers=max_workers
+        )
+        return table.set_index("region")
+
+    def _regional_fit(self, parent_name, parent_params, children, data, fits):
+        x_max = max(np.max(data[i][0]) for i in children)
+        parent_x = np.linspace(0, x_max, n_parent_points)
+
+        regional_fit = RegionalFit(parent_name, parent_x, logistic(parent_x, *parent_params))
+        weights = np.array([data[i][2] for i in children])
+        regional_fit.pop_distrib = weights / weights.sum()
+        regional_fit.data_x = [data[i][0] for i in children]
+        regional_fit.data_y = [data[i][1] for i in children]
+        regional_fit.tolerance_percentage = self.tolerance_percentage
+        regional_fit.initial_guess = list(self.initial_guess)
+        regional_fit.bounds = list(self.bounds)
+        regional_fit.warm_start_from_fits(fits)
+        return regional_fit
+
+    def run(self, solver="SLSQP", options=None, max_workers=max_workers):
+        """
+        Returns one row per region: its parent, level, logistic parameters (a, b, c), how they
+        were obtained ("fit" for the roots, "reconciled" below), success, the RMSE on its own
+        data and, for the reconciled ones, the RMSE of the parent curve and the constraint
+        violation of the parent problem. A parent whose reconciliation failed gets its error on
+        its children rows ("failed"), and its subtree is skipped.
+        """
+        # no solver output from every parent
+        options = {"disp": False, **(options or {})}
+        rows = []
+        # (region, parent name, parameters of the parent or None for a root)
+        level = [(region, None, None) for region in self.regions]
+        depth = 0
+
+        while level:
+            nodes = [region for region, _, _ in level]
+            data = [self._data(region) for region in nodes]
+            if not any(data):
+                break
+            fits = self._fit_level(nodes, data, max_workers)
+
+            params = {}
+            results = {}
+            errors = {}
+            if depth == 0:
+                for i, region in enumerate(nodes):
+                    if data[i] and fits.loc[i, "success"]:
+                        params[i] = fits.loc[i, ["a", "b", "c"]].to_numpy(dtype=float)
+            else:
+                # children with data of every solved parent, solved together
+                groups = {}
+                for i, (_, parent_name, parent_params) in enumerate(level):
+                    if data[i] and parent_params is not None:
+                        groups.setdefault(parent_name, (parent_params, []))[1].append(i)
+
+                problems = {
+                    parent_name: self._regional_fit(parent_name, parent_params, children, data, fits.loc[children])
+                    for parent_name, (parent_params, children) in groups.items()
+                }
+                names = list(problems)
+                if max_workers <= 1:
+                    solved = [_reconcile(problems[name], solver, options) for name in names]
+                else:
+                    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                        solved = list(
+                            executor.map(
+                                _reconcile,
+                                [problems[name] for name in names],
+                                [solver] * len(names),
+                                [options] * len(names),
+                            )
+                        )
+
+                for name, (opt, violation, error) in zip(names, solved):
+                    children = groups[name][1]
+                    if error is not None:
+                        print("The reconciliation failed for ", name, error)
+                        for i in children:
+                            errors[i] = error
+                        continue
+                    children_params = opt.x.reshape(-1, 3)
+                    for j, i in enumerate(children):
+                        params[i] = children_params[j]
+                        results[i] = (bool(opt.success), opt.fun, violation)
+
+            for i, (region, parent_name, _) in enumerate(level):
+                row = {"region": region.name, "parent": parent_name, "level": depth}
+                if i in params:
+                    x, y, weight = data[i]
+                    rmse = np.sqrt(np.mean((y - logistic(x, *params[i])) ** 2))
+                    success, parent_rmse, violation = results.get(i, (bool(fits.loc[i, "success"]), np.nan, np.nan))
+                    row.update(
+                        {
+                            "a": params[i][0],
+                            "b": params[i][1],
+                            "c": params[i][2],
+                            "method": "fit" if depth == 0 else "reconciled",
+                            "success": success,
+                            "rmse": rmse,
+                            "parent_rmse": parent_rmse,
+                            "violation": violation,
+                            "n_points": len(x),
+                            "weight": weight,
+                        }
+                    )
+                else:
+                    row.update({"method": "no data" if not data[i] else "failed", "success": False, "error": errors.get(i)})
+                rows.append(row)
+
+            # the children of the solved regions make the next level
+            level = [
+                (subregion, region.name, params[i])
+                for i, region in enumerate(nodes)
+                if i in params
+                for subregion in region.subregions
+            ]
+            depth += 1
+
+        return pd.DataFrame(
+            rows,
+            columns=[
+                "region", "parent", "level", "a", "b", "c", "method", "success",
+                "rmse", "parent_rmse", "violation", "n_points", "weight", "error",
+            ],
+        )
@@ -0,0 +1,128 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.features import rasterize
+from shapely.geometry import box
+
+from Raster_Windows import iter_windows, max_window_memory
+from Zonal_Stats import same_grid
+
+
+class Label_Raster:
+    """
+    All the subregion polygons of one admin level burnt once into an integer raster aligned
+    to the GHSL grid. Pixel value i (1..N) is the i-th subregion, 0 is outside any subregion.
+    Any band on the same grid is then aggregated per subregion with np.bincount.
+    """
+
+    def __init__(self, file, region_col: str):
+        self.file = file
+        self.region_col = region_col
+        self.region_names = []
+
+    def burn(self, gpd_admin_units, reference_raster, overwrite=False):
+        if os.path.isfile(self.file) and not overwrite:
+            self._read_region_names()
+            return self.file
+
+        admin_units = gpd_admin_units.loc[
+            ~gpd_admin_units.geometry.isnull(), [self.region_col, "geometry"]
+        ].reset_index(drop=True)
+        self.region_names = [str(name) for name in admin_units[self.region_col]]
+
+        with rasterio.open(reference_raster) as ref:
+            if admin_units.crs is not None and admin_units.crs != ref.crs:
+                admin_units = admin_units.to_crs(ref.crs)
+            geometries = admin_units.geometry.values
+            sindex = admin_units.sindex
+
+            out_meta = ref.meta.copy()
+            out_meta.update(
+                {
+                    "driver": "GTiff",
+                    "count": 1,
+                    "dtype": "uint32",
+                    "nodata": 0,
+                    "tiled": True,
+                    "compress": "lzw",  # lossless compression algorithm
+                }
+            )
+
+            os.makedirs(os.path.dirname(self.file), exist_ok=True)
+            with rasterio.open(self.file, "w", **out_meta) as dest:
+                for _, window in dest.block_windows(1):
+                    idx = sindex.query(box(*ref.window_bounds(window)), predicate="intersects")
+                    if len(idx) == 0:
+                        continue
+                    labels = rasterize(
+                        [(geometries[i], i + 1) for i in idx],
+                        out_shape=(window.height, window.width),
+                        transform=ref.window_transform(window),
+                        fill=0,
+                        dtype="uint32",
+                    )
+                    dest.write(labels, 1, window=window)
+
+                dest.update_tags(regions=json.dumps(self.region_names))
+
+        print("Saved a new label tif:\n", self.file)
+        return self.file
+
+    def _read_region_names(self):
+        with rasterio.open(self.file) as src:
+            self.region_names = json.loads(src.tags()["regions"])
+
+    def is_aligned(self, raster_file):
+        with rasterio.open(self.file) as labels, rasterio.open(raster_file) as src:
+            return same_grid(labels, src)
+
+    def aggregate(self, raster_file, band=1, max_memory=max_window_memory):
+        """
+        Sum, valid pixel count, mean, min and max of the band for every subregion.
+        """
+        if not self.is_aligned(raster_file):
+            print("The raster ", raster_file, " is not aligned with the labels ", self.file)
+            return None
+
+        nb_labels = len(self.region_names) + 1
+        sums = np.zeros(nb_labels)
+        counts = np.zeros(nb_labels, dtype=np.int64)
+        mins = np.full(nb_labels, np.inf)
+        maxs = np.full(nb_labels, -np.inf)
+
+        with rasterio.open(self.file) as labels_src, rasterio.open(raster_file) as src:
+            # pixel values, their nodata mask and the uint32 labels
+            bytes_per_pixel = np.dtype(src.dtypes[band - 1]).itemsize + 1 + 4
+            for window in iter_windows(src, band, max_memory, bytes_per_pixel):
+                labels = labels_src.read(1, window=window)
+                data = src.read(band, window=window, masked=True)
+
+                keep = (labels != 0) & ~np.ma.getmaskarray(data)
+                if not keep.any():
+                    continue
+                labels = labels[keep]
+                values = data.data[keep]
+
+                sums += np.bincount(labels, weights=values, minlength=nb_labels)
+                counts += np.bincount(labels, minlength=nb_labels)
+                np.minimum.at(mins, labels, values)
+                np.maximum.at(maxs, labels, values)
+
+        # drop the background label
+        sums, counts, mins, maxs = sums[1:], counts[1:], mins[1:], maxs[1:]
+        empty = counts == 0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            means = np.where(empty, np.nan, sums / np.maximum(counts, 1))
+
+        return pd.DataFrame(
+            {
+                self.region_col: self.region_names,
+                "sum": sums,
+                "count": counts,
+                "mean": means,
+                "min": np.where(empty, np.nan, mins),
+                "max": np.where(empty, np.nan, maxs),
+            }
+        )
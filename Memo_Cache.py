@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import pickle
+import threading
+
+import shapely
+from shapely.geometry.base import BaseGeometry
+
+# bump it when a cached computation changes, so that its previous results are not reused
+code_version = "1"
+
+max_cache_size = 2 * 1024**3  # bytes
+key_lock_stripes = 64  # locks shared by the keys, so that threads asking for the same key compute it once
+
+
+def file_identity(path, checksum=False):
+    """
+    What makes a file "the same" for the cache: its path, size and modification time, or its
+    content (slower) if checksum is True.
+    """
+    stat = os.stat(path)
+    identity = {"path": os.path.abspath(path), "size": stat.st_size}
+    if checksum:
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024**2), b""):
+                sha1.update(chunk)
+        identity["sha1"] = sha1.hexdigest()
+    else:
+        identity["mtime"] = stat.st_mtime_ns
+    return identity
+
+
+def _canonical(value):
+    if isinstance(value, BaseGeometry):
+        return {"wkb_sha1": hashlib.sha1(shapely.to_wkb(value)).hexdigest()}
+    elif isinstance(value, bytes):
+        return {"sha1": hashlib.sha1(value).hexdigest()}
+    elif isinstance(value, dict):
+        return {str(k): _canonical(v) for k, v in value.items()}
+    elif isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    elif value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    else:
+        return str(value)
+
+
+def make_key(step: str, **inputs):
+    """
+    Content address of a pipeline step: hash of the step name, the code version and its inputs
+    (file identities, geometries as WKB, parameters).
+    """
+    payload = json.dumps(
+        {"step": step, "code_version": code_version, "inputs": _canonical(inputs)}, sort_keys=True
+    )
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+class Memo_Cache:
+    """
+    On disk memoization of pipeline steps (clipping, zonal statistics, OSM areas), keyed by
+    make_key. The least recently used entries are evicted when the cache exceeds max_size.
+    """
+
+    _missing = object()
+
+    def __init__(self, folder: str, max_size=max_cache_size):
+        self.folder = folder
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = None  # key -> (last use, size), loaded at the first access
+        self._key_locks = [threading.Lock() for _ in range(key_lock_stripes)]  # picked by the key hash
+
+    def key(self, step: str, **inputs):
+        return make_key(step, **inputs)
+
+    def _path(self, key: str):
+        return os.path.join(self.folder, key[:2], key + ".pkl")
+
+    def _load_entries(self):
+        if self._entries is None:
+            self._entries = {}
+            if os.path.isdir(self.folder):
+                for sub in os.scandir(self.folder):
+                    if not sub.is_dir():
+                        continue
+                    for entry in os.scandir(sub.path):
+                        if entry.name.endswith(".pkl"):
+                            stat = entry.stat()
+                            self._entries[entry.name[:-4]] = (stat.st_mtime_ns, stat.st_size)
+        return self._entries
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            entries = self._load_entries()
+            if key not in entries:
+                return default
+            path = self._path(key)
+            try:
+                with open(path, "rb") as f:
+                    value = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                entries.pop(key, None)
+                return default
+
+            # the modification time records the last use for the LRU eviction
+            os.utime(path)
+            entries[key] = (os.stat(path).st_mtime_ns, entries[key][1])
+            return value
+
+    def put(self, key: str, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(value, f)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            entries = self._load_entries()
+            stat = os.stat(path)
+            entries[key] = (stat.st_mtime_ns, stat.st_size)
+            self._evict()
+
+    def _evict(self):
+        total = sum(size for _, size in self._entries.values())
+        if total <= self.max_size:
+            return
+
+        for key, (_, size) in sorted(self._entries.items(), key=lambda item: item[1][0]):
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            del self._entries[key]
+            total -= size
+            if total <= self.max_size:
+                break
+
+    def cached(self, key: str, compute):
+        """
+        Value stored under key, computed with compute() and stored if missing.
+        """
+        with self._key_locks[int(key[:8], 16) % len(self._key_locks)]:
+            value = self.get(key, self._missing)
+            if value is self._missing:
+                value = compute()
+                self.put(key, value)
+        return value
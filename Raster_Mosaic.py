@@ -0,0 +1,132 @@
+import os
+import xml.etree.ElementTree as ET
+
+import rasterio
+from rasterio.merge import merge
+
+from Raster_Windows import max_window_memory
+
+gdal_types = {
+    "uint8": "Byte",
+    "int8": "Int8",
+    "uint16": "UInt16",
+    "int16": "Int16",
+    "uint32": "UInt32",
+    "int32": "Int32",
+    "uint64": "UInt64",
+    "int64": "Int64",
+    "float32": "Float32",
+    "float64": "Float64",
+}
+
+
+def build_vrt(raster_files, vrt_file: str):
+    """
+    Virtual mosaic of rasters on the same grid (CRS, resolution, dtype and bands), e.g. the
+    subregions clipped from one global raster: a small XML file referencing them, which GDAL
+    and rasterio read as one raster without copying any pixel. The paths are stored relative
+    to the VRT when possible, so that the folder can be moved as a whole.
+    """
+    profiles = []
+    for file in raster_files:
+        with rasterio.open(file) as src:
+            profiles.append(
+                {
+                    "file": file,
+                    "crs": src.crs,
+                    "transform": src.transform,
+                    "width": src.width,
+                    "height": src.height,
+                    "count": src.count,
+                    "dtypes": src.dtypes,
+                    "nodata": src.nodata,
+                    "block_shapes": src.block_shapes,
+                }
+            )
+    if not profiles:
+        print("No raster to mosaic in ", vrt_file)
+        return None
+
+    first = profiles[0]
+    res = (first["transform"].a, first["transform"].e)
+    for profile in profiles[1:]:
+        if (
+            profile["crs"] != first["crs"]
+            or (profile["transform"].a, profile["transform"].e) != res
+            or profile["count"] != first["count"]
+            or profile["dtypes"] != first["dtypes"]
+        ):
+            print("The raster ", profile["file"], " is not on the same grid as ", first["file"], ", use merge_rasters.")
+            return None
+
+    left = min(p["transform"].c for p in profiles)
+    top = max(p["transform"].f for p in profiles)
+    right = max(p["transform"].c + p["width"] * res[0] for p in profiles)
+    bottom = min(p["transform"].f + p["height"] * res[1] for p in profiles)
+    width = int(round((right - left) / res[0]))
+    height = int(round((bottom - top) / res[1]))
+
+    root = ET.Element("VRTDataset", rasterXSize=str(width), rasterYSize=str(height))
+    if first["crs"] is not None:
+        ET.SubElement(root, "SRS", dataAxisToSRSAxisMapping="1,2").text = first["crs"].to_wkt()
+    ET.SubElement(root, "GeoTransform").text = ", ".join(repr(v) for v in (left, res[0], 0.0, top, 0.0, res[1]))
+
+    vrt_folder = os.path.dirname(os.path.abspath(vrt_file))
+    for band in range(1, first["count"] + 1):
+        dtype = first["dtypes"][band - 1]
+        band_element = ET.SubElement(root, "VRTRasterBand", dataType=gdal_types[dtype], band=str(band))
+        if first["nodata"] is not None:
+            ET.SubElement(band_element, "NoDataValue").text = repr(first["nodata"])
+
+        for profile in profiles:
+            source = ET.SubElement(band_element, "ComplexSource")
+            path = os.path.abspath(profile["file"])
+            relative = os.path.relpath(path, vrt_folder) if os.path.splitdrive(path)[0] == os.path.splitdrive(vrt_folder)[0] else None
+            ET.SubElement(source, "SourceFilename", relativeToVRT="1" if relative else "0").text = relative or path
+            ET.SubElement(source, "SourceBand").text = str(band)
+            block_height, block_width = profile["block_shapes"][band - 1]
+            ET.SubElement(
+                source,
+                "SourceProperties",
+                RasterXSize=str(profile["width"]),
+                RasterYSize=str(profile["height"]),
+                DataType=gdal_types[dtype],
+                BlockXSize=str(block_width),
+                BlockYSize=str(block_height),
+            )
+            ET.SubElement(source, "SrcRect", xOff="0", yOff="0", xSize=str(profile["width"]), ySize=str(profile["height"]))
+            ET.SubElement(
+                source,
+                "DstRect",
+                xOff=str(int(round((profile["transform"].c - left) / res[0]))),
+                yOff=str(int(round((profile["transform"].f - top) / res[1]))),
+                xSize=str(profile["width"]),
+                ySize=str(profile["height"]),
+            )
+            # the nodata pixels of a source do not hide the other sources
+            if profile["nodata"] is not None:
+                ET.SubElement(source, "NODATA").text = repr(profile["nodata"])
+
+    os.makedirs(vrt_folder, exist_ok=True)
+    ET.ElementTree(root).write(vrt_file)
+    return vrt_file
+
+
+def merge_rasters(raster_files, output_file: str, max_memory=max_window_memory):
+    """
+    Mosaic of the rasters written as a tiled LZW GeoTIFF by chunks of at most max_memory
+    bytes, the sources being opened only while a chunk is read, so that the whole mosaic is
+    never held in memory.
+    """
+    if not raster_files:
+        print("No raster to merge in ", output_file)
+        return None
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    merge(
+        list(raster_files),
+        dst_path=output_file,
+        dst_kwds={"driver": "GTiff", "compress": "lzw", "tiled": True, "blockxsize": 256, "blockysize": 256, "BIGTIFF": "IF_SAFER"},
+        mem_limit=max(int(max_memory / 1e6), 1),
+    )
+    return output_file
@@ -0,0 +1,41 @@
+import numpy as np
+from rasterio.windows import Window
+
+# memory ceiling (in bytes) of the arrays read at once when streaming over a raster
+max_window_memory = 256 * 1024**2
+
+
+def accumulator_dtype(dtype):
+    """
+    Wide dtype used to accumulate sums of pixels of the given dtype without overflow.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind == "u":
+        return np.dtype(np.uint64)
+    elif dtype.kind in ("i", "b"):
+        return np.dtype(np.int64)
+    else:
+        return np.dtype(np.float64)
+
+
+def iter_windows(src, band=1, max_memory=max_window_memory, bytes_per_pixel=None):
+    """
+    Windows covering the whole raster, aligned on its internal blocks. Rows of blocks are
+    grouped as long as a window stays under max_memory; if a single row of blocks is already
+    too big, the raster is walked block by block.
+    """
+    if bytes_per_pixel is None:
+        # the pixel values and their nodata mask
+        bytes_per_pixel = np.dtype(src.dtypes[band - 1]).itemsize + 1
+
+    block_height, _ = src.block_shapes[band - 1]
+    row_memory = src.width * block_height * bytes_per_pixel
+
+    if row_memory > max_memory:
+        for _, window in src.block_windows(band):
+            yield window
+        return
+
+    window_height = (max_memory // row_memory) * block_height
+    for row_off in range(0, src.height, window_height):
+        yield Window(0, row_off, src.width, min(window_height, src.height - row_off))
@@ -1,6 +1,13 @@
+from Admin_Index import Admin_Index
+from Clip_Executor import Clip_Executor
 from Df import Df
 from GIS_Raster import GIS_Raster
+from GIS_RasterStack import GIS_RasterStack
 from GIS_Shapefile import GIS_Shapefile
+from Label_Raster import Label_Raster
+from Raster_Mosaic import build_vrt, merge_rasters
+from Rollup import GHSL_OECD_rollup
+from UCDB_Snapshot import UCDB_Snapshot
 
 import os
 import geopandas as gpd
@@ -33,6 +40,7 @@ class Region:
 
         self.subregions = []
         self.urban_centres = []
+        self.label_raster = None  # subregions burnt into one raster, see make_subregions_labels
 
         # outputs
         self.output_df = None #supposed to be the final DF with the observed values
@@ -109,124 +117,246 @@ class Region:
         self.output_df_merged = reduce(lambda left, right: pd.merge(left, right, on=col), df_list)
 
 
-    def make_subregions(self, gpd_admin_units, subregion_col: str, parent_region_col: str, overwrite=False):
-        for index, row in gpd_admin_units.iterrows():
-            if row[parent_region_col] == self.name:  
-                subregion = Region(str(row[subregion_col]), self.lvl + 1)
-                subregion.parent_name = self.name
-                subregion.geometry = row.geometry
-                subregion.crs = gpd_admin_units.crs
-
-                for gis in self.gis_list:
-                    if not os.path.isfile(os.path.join(os.path.dirname(gis.file), os.path.join(self.name, "subregions"),
-                                f"{row[subregion_col]}.tif",)) or overwrite:
-                        sub_gis = gis.make_mask(
-                            gpd_admin_units, row[subregion_col], subregion_col, self.name, overwrite=overwrite
-                        )
-
-                        if not sub_gis:
-                            print("Something went wrong with the mask!")
-                        else:
-                            subregion.add_gis(
-                                sub_gis,
-                                name=gis.name,
-                                year=gis.year,
-                                lvl=self.lvl + 1,
-                            )
-                    else:
-                        subregion.add_gis(
-                                os.path.join(os.path.dirname(gis.file), os.path.join(self.name, "subregions"),
-                                f"{row[subregion_col]}.tif",),
-                                name=gis.name,
-                                year=gis.year,
-                                lvl=self.lvl + 1,
-                            )
-                        
-                ###
-                self.subregions.append(subregion)
+    def make_subregions(self, gpd_admin_units, subregion_col: str, parent_region_col: str, overwrite=False, memo_cache=None, max_workers=1):
+        # with a memo_cache, existing subregion rasters are checked against their source raster and geometry
+        # every raster is clipped along all the subregions in one Clip_Executor run, by max_workers processes
+        index = Admin_Index.of(gpd_admin_units, subregion_col, parent_region_col)
+        subregions = self._new_subregions(index, gpd_admin_units.crs)
+
+        for gis in self.gis_list:
+            if gis.type != "raster":
+                print(f"Something went wrong with the mask! {gis.name} is not a raster.")
+                continue
+
+            sub_folder = os.path.join(os.path.dirname(gis.file), self.name, "subregions")
+            tasks = [
+                (subregion_id, os.path.join(sub_folder, f"{subregion_id}.tif"), index.geometry(subregion_id, crs=gis.get_crs()))
+                for subregion_id in subregions
+            ]
+            report = Clip_Executor(gis.file, max_workers=max_workers, overwrite=overwrite, memo_cache=memo_cache).run(tasks)
+
+            done = report.loc[report["status"] != "failed"].set_index("name")["file"]
+            for subregion_id, subregion in subregions.items():
+                if subregion_id in done.index:
+                    subregion.add_gis(done[subregion_id], name=gis.name, year=gis.year, lvl=self.lvl + 1)
+            if (report["status"] == "done").any():
+                print(f"Saved {int((report['status'] == 'done').sum())} new tifs in\n", sub_folder)
+
+        self.subregions.extend(subregions.values())
+
+        print(colored(f"END: {self.name}", "green"))
+
+    def make_subregions_zonal(self, gpd_admin_units, subregion_col: str, parent_region_col: str):
+        """
+        Alternative to make_subregions for get_subregions_zonal_stats: the subregions are
+        created without clipping the region's rasters.
+        """
+        index = Admin_Index.of(gpd_admin_units, subregion_col, parent_region_col)
+        self.subregions.extend(self._new_subregions(index, gpd_admin_units.crs).values())
+
+    def _new_subregions(self, index, crs):
+        subregions = {}
+        for subregion_id in index.children(self.name):
+            subregion = Region(str(subregion_id), self.lvl + 1)
+            subregion.parent_name = self.name
+            subregion.geometry = index.geometry(subregion_id)
+            subregion.crs = crs
+            subregions[subregion_id] = subregion
+        return subregions
+
+    def make_subregions_labels(self, gpd_admin_units, subregion_col: str, parent_region_col: str, overwrite=False):
+        """
+        Alternative to make_subregions: instead of cutting one raster per subregion and per GIS,
+        the subregions are burnt once into a label raster aligned to the region's rasters.
+        Use aggregate_subregions to get the values of every GIS per subregion.
+        """
+        rasters = [gis for gis in self.gis_list if gis.type == "raster"]
+        if not rasters:
+            print(f"No raster to align the labels of {self.name} on.")
+            return
+
+        index = Admin_Index.of(gpd_admin_units, subregion_col, parent_region_col)
+        self.subregions.extend(self._new_subregions(index, gpd_admin_units.crs).values())
+
+        children = gpd_admin_units.loc[gpd_admin_units[parent_region_col] == self.name]
+
+        # the GHSL products and years of a region share the same grid
+        label_file = os.path.join(os.path.dirname(rasters[0].file), self.name, "labels", f"{subregion_col}.tif")
+        self.label_raster = Label_Raster(label_file, subregion_col)
+        self.label_raster.burn(children, rasters[0].file, overwrite=overwrite)
 
         print(colored(f"END: {self.name}", "green"))
 
-    def make_subregions_visual(self, gpd_admin_units, subregion_col: str, parent_region_col: str, output_csv_paths: list, years):
+    def aggregate_subregions(self, gis_names=None):
+        """
+        Values of the region's rasters per subregion, read from the label raster.
+        Returns one DataFrame with a row per (subregion, gis).
+        """
+        if self.label_raster is None:
+            print(f"No label raster for {self.name}, call make_subregions_labels first.")
+            return None
+
+        stats_list = []
+        for gis in self.gis_list:
+            if gis.type != "raster" or (gis_names is not None and gis.name not in gis_names):
+                continue
+            stats = self.label_raster.aggregate(gis.file)
+            if stats is None:
+                continue
+            stats.insert(1, "gis", gis.name)
+            stats.insert(2, "year", gis.year)
+            stats_list.append(stats)
+
+        if not stats_list:
+            return None
+
+        return pd.concat(stats_list, ignore_index=True)
+
+    def make_raster_stacks(self):
+        """
+        Groups the rasters of the region that share the same grid (e.g. all the GHSL
+        products and years) so that their statistics are computed in one pass.
+        """
+        stacks = []
+        for gis in self.gis_list:
+            if gis.type != "raster":
+                continue
+            stack = next((stack for stack in stacks if stack.matches(gis)), None)
+            if stack is None:
+                stack = GIS_RasterStack(f"{self.name}_{len(stacks)}", self.lvl)
+                stacks.append(stack)
+            stack.add_raster(gis)
+        return stacks
+
+    def make_subregions_mosaic(self, gis_name: str, output_file: str):
+        """
+        Mosaic of the gis_name rasters of the subregions: virtual (no pixel copied) if
+        output_file is a .vrt, otherwise a GeoTIFF written by bounded chunks.
+        """
+        files = [gis.file for subregion in self.subregions for gis in subregion.gis_list if gis.name == gis_name and gis.type == "raster"]
+        if output_file.endswith(".vrt"):
+            return build_vrt(files, output_file)
+        return merge_rasters(files, output_file)
+
+    def get_subregions_zonal_stats(self, gpd_admin_units, subregion_col: str, parent_region_col: str, memo_cache=None):
+        """
+        Zonal statistics of every GIS raster of the region for all its subregions, without
+        writing the subregion rasters. Returns one DataFrame with a row per (subregion, gis).
+        """
+        children = gpd_admin_units.loc[gpd_admin_units[parent_region_col] == self.name]
+
+        stats_list = []
+        for stack in self.make_raster_stacks():
+            stats = stack.get_zonal_stats(children, subregion_col, memo_cache=memo_cache)
+            if stats is not None:
+                stats_list.append(stats)
+
+        if not stats_list:
+            print(f"No raster to compute zonal statistics for {self.name}.")
+            return None
+
+        return pd.concat(stats_list, ignore_index=True)
+
+    def make_subregions_visual(self, gpd_admin_units, subregion_col: str, parent_region_col: str, result_store, products: list, years):
         # this function is meant to be use for the visualization part only, not the preprocessing one.
-        # TODO: output_csv_path and output_name should be a list to loop on
-        for index, row in gpd_admin_units.iterrows():
-            if row[parent_region_col] == self.name:  # OECD specific
-                try:
-                    subregion = Region(str(row[subregion_col]), self.lvl + 1)
-                    subregion.parent_name = self.name
-                    for output_csv_path in output_csv_paths:
-                        subregion.output_df_list.append(Df(pd.read_csv(os.path.join(output_csv_path, subregion.parent_name, subregion.name, '_'.join(years))+".csv"), ""))
-                    subregion.merge_output_dfs("year")
-                    self.subregions.append(subregion)
-                except Exception as e:
-                    print(e)
+        index = Admin_Index.of(gpd_admin_units, subregion_col, parent_region_col)
+        self.make_subregions_from_store(result_store, products, years, regions=index.children(self.name))
 
-    def make_subregions_ucdb(self, ucdb_file, uc_col: str, parent_col: str):
-        for _, row in ucdb_file.iterrows():
-            if row[parent_col] == self.name:
-                subregion = Region(row[uc_col], self.lvl + 1)
+    def make_subregions_from_store(self, result_store, products: list, years, regions=None):
+        """
+        Visualization subregions read from a Result_Store: one filtered read for all the
+        subregions (or only regions) and products of the region instead of one CSV per
+        subregion. The values stored without a year (e.g. OSM areas) are repeated on every year.
+        """
+        regions = None if regions is None else [str(region) for region in regions]
+        wide = result_store.read_wide(products=products, parents=[self.name], regions=regions, years=years)
+
+        subregions = {}
+        static = {}  # region name -> DataFrames without a year
+        for (region_name, product), df in wide.groupby(["region", "product"], sort=False):
+            if region_name not in subregions:
+                subregion = Region(region_name, self.lvl + 1)
                 subregion.parent_name = self.name
-                self.subregions.append(subregion)
+                subregions[region_name] = subregion
+            df = df.drop(columns=["product", "parent", "region"]).dropna(axis=1, how="all")
+            if "year" not in df.columns:
+                static.setdefault(region_name, []).append(df.reset_index(drop=True))
+            else:
+                subregions[region_name].output_df_list.append(Df(df.reset_index(drop=True), product))
+
+        for region_name, subregion in subregions.items():
+            if subregion.output_df_list:
+                subregion.merge_output_dfs("year")
+            for df in static.get(region_name, []):
+                merged = subregion.output_df_merged
+                subregion.output_df_merged = df if merged is None else merged.merge(df, how="cross")
+                subregion.output_df_list.append(Df(df, ""))
+            self.subregions.append(subregion)
 
-    def make_subregions_ucdb_visual(self, ucdb_file, uc_col: str, parent_col: str, years):
-        for _, row in ucdb_file.iterrows():
-            if row[parent_col] == self.name:
-                subregion = Region(row[uc_col], self.lvl + 1)
-                subregion.parent_name = self.name
-                try:
-                    subregion.output_df_list.append(Df(pd.read_csv("/data/mineralogie/hautervo/data/Outputs/UCDB/"+subregion.parent_name+"/"+subregion.name+"/"+'_'.join(years)+".csv"), ""))
-                    subregion.merge_output_dfs("year")
-                except Exception as e:
-                    print(e)
-                self.subregions.append(subregion)
+    def make_subregions_ucdb(self, ucdb_file, uc_col: str, parent_col: str):
+        """
+        ucdb_file is the UCDB DataFrame, or a UCDB_Snapshot whose GHSL sheet is used.
+        """
+        if isinstance(ucdb_file, UCDB_Snapshot):
+            ucdb_file = ucdb_file.sheet("GHSL", [uc_col, parent_col])
+        for uc_name in Admin_Index.of(ucdb_file, uc_col, parent_col).children(self.name):
+            subregion = Region(uc_name, self.lvl + 1)
+            subregion.parent_name = self.name
+            self.subregions.append(subregion)
+
+    def make_subregions_ucdb_visual(self, ucdb_file, uc_col: str, parent_col: str, result_store, products: list, years):
+        if isinstance(ucdb_file, UCDB_Snapshot):
+            ucdb_file = ucdb_file.sheet("GHSL", [uc_col, parent_col])
+        index = Admin_Index.of(ucdb_file, uc_col, parent_col)
+        self.make_subregions_from_store(result_store, products, years, regions=index.children(self.name))
 
     
+    def rollup(self, rollup, levels=None):
+        """
+        Computes the output_df of the region and of all its intermediate subregions from the
+        output_df of the leaves (subregions without subregions, or `levels` below this region)
+        with the Rollup aggregation, in one call. Returns the long table of all the parents.
+        """
+        nodes = {}
+        ancestors = {}
+        leaves = []
+
+        def walk(region, chain, depth):
+            if not region.has_subregions() or (levels is not None and depth == levels):
+                if chain and region.output_df is not None:
+                    leaves.append(region)
+                    ancestors[id(region)] = chain
+                return
+            nodes[id(region)] = region
+            for subregion in region.subregions:
+                walk(subregion, chain + [id(region)], depth + 1)
+
+        walk(self, [], 0)
+        if not leaves:
+            print(f"No subregion output_df to roll up for {self.name}.")
+            return None
+
+        long_df = pd.concat([leaf.output_df.assign(node=id(leaf)) for leaf in leaves], ignore_index=True)
+        result = rollup.rollup(long_df, ancestors, region_col="node")
+
+        for node, df in result.groupby("node", sort=False):
+            nodes[node].output_df = df.drop(columns="node").reset_index(drop=True)
+
+        result.insert(0, "region", result.pop("node").map(lambda node: nodes[node].name))
+        return result
+
     def compute_own_df(self, years, type: str):
-        # TODO: this should be changed to use the output_df_list instead
         if type == "GHSL_OECD":
-            self.output_df = pd.DataFrame({"year": years, "GDP per capita":None, "Population_OECD": None, "Population_GHSL":None, "Built up surface GHSL/Population_OECD": None, "Population_OECD/Total surface": None})
-
-            for y in years:
-                gdp_sum = 0
-                population_OECD = 0
-                population_GHSL = 0
-                ghsl_surface = 0
-                total_surface = 0
-
-                for subregion in self.subregions:                  
-                    # intensive
-                    population_GHSL += subregion.output_df.loc[subregion.output_df["year"]==int(y), "Population_GHSL"].sum()
-                    population_OECD += subregion.output_df.loc[subregion.output_df["year"]==int(y), "Population_OECD"].sum()
-                    ghsl_surface += subregion.output_df.loc[subregion.output_df["year"]==int(y), "Built up surface GHSL"].sum()
-                    total_surface += subregion.output_df.loc[subregion.output_df["year"]==int(y), "Total surface"].sum()
-                    # extensive
-                    gdp_sum += subregion.output_df.loc[subregion.output_df["year"]==int(y), "GDP per capita"].sum() * subregion.output_df.loc[subregion.output_df["year"]==int(y), "Population_OECD"].sum()
-                
-                # Finally
-                if population_OECD != 0:
-                    if gdp_sum != 0:
-                        self.output_df.loc[self.output_df["year"]==y, "GDP per capita"] = gdp_sum/population_OECD
-                    else:
-                        pass
-
-                    self.output_df.loc[self.output_df["year"]==y, "Built up surface GHSL/Population_OECD"] = ghsl_surface / population_OECD
-                    self.output_df.loc[self.output_df["year"]==y, "Population_OECD"] = population_OECD
-                    self.output_df.loc[self.output_df["year"]==y, "Population_OECD/Total surface"] = population_OECD / total_surface
-                
-                # same but with the pop computed by GHSL
-                if gdp_sum != 0:
-                    self.output_df.loc[self.output_df["year"]==y, "GDP per capita"] = gdp_sum/population_GHSL
-                else:
-                    pass
-        
-                self.output_df.loc[self.output_df["year"]==y, "Built up surface GHSL/Population_GHSL"] = ghsl_surface / population_GHSL
-                self.output_df.loc[self.output_df["year"]==y, "Population_GHSL"] = population_GHSL
-                self.output_df.loc[self.output_df["year"]==y, "Population_GHSL/Total surface"] = population_GHSL / total_surface
-
-                # these should always be found
-                self.output_df.loc[self.output_df["year"]==y, "Built up surface GHSL"] = ghsl_surface
-                self.output_df.loc[self.output_df["year"]==y, "Total surface"] = total_surface
+            self.rollup(GHSL_OECD_rollup, levels=1)
+            if self.output_df is None:
+                return
+
+            # one row per requested year, in the same order
+            self.output_df["year"] = self.output_df["year"].astype(int)
+            self.output_df = self.output_df.set_index("year").reindex([int(y) for y in years]).reset_index(drop=True)
+            self.output_df.insert(0, "year", years)
+        else:
+            print(f"Type of output to compute : {type} not understood.")
 
     def compute_vector_area(self, gis_name: str, output_df_name: str):
         vector = next((x for x in self.gis_list if x.name == gis_name), None)
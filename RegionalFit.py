@@ -1,8 +1,28 @@
-from scipy.optimize import minimize
 import numpy as np
-from functools import partial
 import matplotlib.pyplot as plt
+import pandas as pd
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from scipy.sparse import csr_matrix
+from scipy.stats import qmc
+
+import Fit_Models
+from RegionalFit_Solvers import bounds_arrays, solvers
+
+max_workers = 12
+
+
+def _run_start(regional_fit, start, initial_guess, bounds, solver, options):
+    """
+    One start of RegionalFit.optimize_multistart, run in a worker process.
+    """
+    t = time.perf_counter()
+    try:
+        return start, solvers[solver](regional_fit, initial_guess, bounds, options), time.perf_counter() - t, None
+    except Exception as e:
+        return start, None, time.perf_counter() - t, repr(e)
+
 
 class RegionalFit:
     def __init__(self, name, parent_x, parent_y,):
@@ -18,13 +38,21 @@ class RegionalFit:
         self.constraints = []
         self.opt = None
 
+        # data points flattened by define_constraints
+        self.points_idx = None
+        self.points_x = None
+        self.points_y = None
+        self.weights = None
+
         self.parent_y_pred = []
         self.mse = np.nan
         self.rmse = np.nan
         self.r_squared = np.nan
 
         self.tolerance_percentage = None
+        # shared by all the subregions, or one per subregion (see the warm_start_* methods)
         self.initial_guess = [50, 0.0003, 18000] 
+        self.starts_report = None
         self.bounds = [(10, 250), (0.0001, 0.001), (10000, None)]
         self.nb_vars = 3
         self.colors_reg = ["blue", "orange", "green", "peru", "darkorange", "gold", "purple", "magenta", "chartreuse", "turquoise", "darkcyan", "deepskyblue", "brown",]
@@ -35,50 +63,115 @@ class RegionalFit:
         self.parent_y_fit = []
 
     def logistic(self, x, s, k, x0):
-        return s / (1 + np.exp(-k*(x-x0)))
-    
-    def constraint_datapoint(self, vars, subregion_idx=0, point_idx=0):
-        return self.logistic(self.data_x[subregion_idx][point_idx], vars[subregion_idx*self.nb_vars+0], vars[subregion_idx*self.nb_vars+1], vars[subregion_idx*self.nb_vars+2]) - self.data_y[subregion_idx][point_idx]  
-
-    def upper_bound_constraint(self, vars, subregion_idx=0, point_idx=0,):
-        """Constraint that allows the function to pass near a point within a given tolerance."""
-        logistic_value = self.logistic(
-            self.data_x[subregion_idx][point_idx],
-            vars[subregion_idx * self.nb_vars + 0],
-            vars[subregion_idx * self.nb_vars + 1],
-            vars[subregion_idx * self.nb_vars + 2]
-        )
-        observed_value = self.data_y[subregion_idx][point_idx]
+        return Fit_Models.logistic(x, s, k, x0)
 
-        # Calculate the relative tolerance
-        relative_tolerance = self.tolerance_percentage / 100 * observed_value
+    def _flatten_data(self):
+        # all the data points in flat arrays, with the index of their subregion
+        self.points_idx = np.concatenate([np.full(len(x), i) for i, x in enumerate(self.data_x)]).astype(int)
+        self.points_x = np.concatenate([np.asarray(x, dtype=float) for x in self.data_x])
+        self.points_y = np.concatenate([np.asarray(y, dtype=float) for y in self.data_y])
 
-        # Constraint to enforce: logistic_value <= observed_value + relative_tolerance
-        return observed_value + relative_tolerance - logistic_value
+        # weight of every subregion at every parent_x, a scalar share or one value per parent_x
+        weights = np.asarray(self.pop_distrib, dtype=float).reshape(len(self.pop_distrib), -1)
+        self.weights = np.broadcast_to(weights, (len(self.pop_distrib), len(self.parent_x)))
 
-    def lower_bound_constraint(self, vars, subregion_idx=0, point_idx=0):
-        logistic_value = self.logistic(
-            self.data_x[subregion_idx][point_idx],
-            vars[subregion_idx * self.nb_vars + 0],
-            vars[subregion_idx * self.nb_vars + 1],
-            vars[subregion_idx * self.nb_vars + 2]
-        )
-        observed_value = self.data_y[subregion_idx][point_idx]
+    def _jacobian_columns(self):
+        # column of the parameter j of the subregion of every data point
+        return self.points_idx[:, None] * self.nb_vars + np.arange(self.nb_vars)
+
+    def constraint_values(self, vars):
+        """
+        Logistic of every subregion minus its data points, all the points at once.
+        """
+        params = vars.reshape(-1, self.nb_vars)[self.points_idx]
+        return self.logistic(self.points_x, *params.T) - self.points_y
+
+    def _constraint_jacobian_entries(self, vars):
+        # a data point only depends on the parameters of its own subregion
+        params = vars.reshape(-1, self.nb_vars)[self.points_idx]
+        return np.column_stack(Fit_Models.logistic_partials(self.points_x, *params.T)), self._jacobian_columns()
+
+    def constraint_jacobian(self, vars):
+        entries, cols = self._constraint_jacobian_entries(vars)
+        jac = np.zeros((len(self.points_x), len(vars)))
+        np.put_along_axis(jac, cols, entries, axis=1)
+        return jac
+
+    def constraint_jacobian_sparse(self, vars):
+        entries, cols = self._constraint_jacobian_entries(vars)
+        rows = np.repeat(np.arange(len(self.points_x)), self.nb_vars)
+        return csr_matrix((entries.ravel(), (rows, cols.ravel())), shape=(len(self.points_x), len(vars)))
 
-        # Calculate the relative tolerance
-        relative_tolerance = self.tolerance_percentage / 100 * observed_value
+    def constraint_hessian(self, vars, v):
+        """
+        Sum of v_p times the Hessian of the constraint of every data point p: a block diagonal
+        sparse matrix, with one 3x3 block per subregion.
+        """
+        params = vars.reshape(-1, self.nb_vars)[self.points_idx]
+        aa, ab, ac, bb, bc, cc = Fit_Models.logistic_second_partials(self.points_x, *params.T)
+        blocks = np.stack([aa, ab, ac, ab, bb, bc, ac, bc, cc], axis=1) * np.asarray(v)[:, None]
 
-        # Constraint to enforce: logistic_value >= observed_value - relative_tolerance
-        return logistic_value - (observed_value - relative_tolerance)
+        cols = self._jacobian_columns()
+        rows = np.repeat(cols, self.nb_vars, axis=1)
+        cols = np.tile(cols, self.nb_vars)
+        # the duplicated entries of the points of a same subregion are summed
+        return csr_matrix((blocks.ravel(), (rows.ravel(), cols.ravel())), shape=(len(vars), len(vars)))
+
+    def constraint_bounds(self):
+        """
+        Lower and upper bounds of constraint_values: 0 for the equality constraints, or the
+        tolerance around the data points.
+        """
+        if self.tolerance_percentage is None:
+            return np.zeros_like(self.points_y), np.zeros_like(self.points_y)
+        relative_tolerance = self.tolerance_percentage / 100 * self.points_y
+        return -relative_tolerance, relative_tolerance
+
+    def tolerance_constraint_values(self, vars):
+        """
+        Logistic within tolerance_percentage of the data points: the upper bound constraints
+        followed by the lower bound ones, all >= 0.
+        """
+        relative_tolerance = self.tolerance_percentage / 100 * self.points_y
+        diff = self.constraint_values(vars)
+        return np.concatenate([relative_tolerance - diff, diff + relative_tolerance])
+
+    def tolerance_constraint_jacobian(self, vars):
+        jac = self.constraint_jacobian(vars)
+        return np.vstack([-jac, jac])
+
+    def _parent_residuals(self, vars):
+        params = vars.reshape(-1, self.nb_vars)
+        x = np.asarray(self.parent_x, dtype=float)[None, :]
+        values = self.logistic(x, params[:, 0:1], params[:, 1:2], params[:, 2:3])
+        return self.parent_y - (self.weights * values).sum(axis=0), params, x
+
+    def parent_residuals_jacobian(self, vars):
+        """
+        Jacobian of the parent residuals, of shape (len(parent_x), len(vars)).
+        """
+        _, params, x = self._parent_residuals(vars)
+        partials = Fit_Models.logistic_partials(x, params[:, 0:1], params[:, 1:2], params[:, 2:3])
+        # (subregions, params, parent_x) -> (parent_x, subregions * params)
+        jac = -np.stack([self.weights * partial for partial in partials], axis=1)
+        return jac.reshape(len(vars), -1).T
 
     def objective(self, vars):
-        y_pred = np.zeros_like(self.parent_y)  # Initialize as array instead of list
-        
-        for idx in range(len(self.pop_distrib)):
-            y_pred += self.pop_distrib[idx]*self.logistic(self.parent_x, vars[idx*self.nb_vars], vars[idx*self.nb_vars+1], vars[idx*self.nb_vars+2])
-    
-        return np.sqrt(np.mean((self.parent_y - y_pred) ** 2))
-    
+        residuals, _, _ = self._parent_residuals(vars)
+        return np.sqrt(np.mean(residuals**2))
+
+    def objective_gradient(self, vars):
+        residuals, params, x = self._parent_residuals(vars)
+        rmse = np.sqrt(np.mean(residuals**2))
+        if rmse == 0:
+            return np.zeros_like(vars)
+
+        # d rmse / d param = - sum_t residual_t * weight_t * d logistic_t / d param / (T * rmse)
+        partials = Fit_Models.logistic_partials(x, params[:, 0:1], params[:, 1:2], params[:, 2:3])
+        weighted_residuals = self.weights * residuals
+        grad = np.column_stack([(weighted_residuals * partial).sum(axis=1) for partial in partials])
+        return -grad.ravel() / (residuals.size * rmse)
+
     def define_constraints(self):
         if self.pop_distrib is None:
             print("Please put the population distribution")
@@ -87,29 +180,31 @@ class RegionalFit:
             print("No data points !")
             sys.exit()
 
-        for i in range(len(self.data_x)):
-            for ii in range(len(self.data_x[i])):
-                if self.tolerance_percentage is None:
-                    self.constraints.append({'type': 'eq', 'fun': partial(self.constraint_datapoint, subregion_idx=i, point_idx=ii)})
-                else:    
-                    self.constraints.append({
-                        'type': 'ineq',
-                        'fun': partial(self.upper_bound_constraint, subregion_idx=i, point_idx=ii)})
-                    self.constraints.append({
-                        'type': 'ineq',
-                        'fun': partial(self.lower_bound_constraint, subregion_idx=i, point_idx=ii)})
+        self._flatten_data()
+        if self.tolerance_percentage is None:
+            self.constraints = [{"type": "eq", "fun": self.constraint_values, "jac": self.constraint_jacobian}]
+        else:
+            self.constraints = [
+                {"type": "ineq", "fun": self.tolerance_constraint_values, "jac": self.tolerance_constraint_jacobian}
+            ]
 
+    def optimize(self, solver="SLSQP", options=None):
+        """
+        solver is one of RegionalFit_Solvers.solvers: "SLSQP" (dense, for small problems),
+        "trust-constr" (sparse) or "augmented-lagrangian" (L-BFGS-B, for the largest problems).
+        """
+        if solver not in solvers:
+            print("Solver ", solver, " not recognised, use one of ", list(solvers))
+            sys.exit()
 
-    def optimize(self):
         self.define_constraints()
         # Initial guess
-        initial_guess = self.initial_guess * len(self.data_x)
+        initial_guess = self._initial_guess_vector()
 
         bounds = self.bounds * len(self.data_x)
 
         # Perform the optimization
-        self.opt = minimize(self.objective, initial_guess, bounds=bounds, constraints=self.constraints, method="SLSQP",    options={"maxiter": 10000, "disp": True}
-)
+        self.opt = solvers[solver](self, initial_guess, bounds, options or {})
 
         # Display the opt
         if self.opt.success:
@@ -118,6 +213,136 @@ class RegionalFit:
         else:
             print("Optimization failed:", self.opt.message)
 
+    def _initial_guess_vector(self):
+        guess = np.asarray(self.initial_guess, dtype=float)
+        if guess.ndim == 1:
+            guess = np.tile(guess, len(self.data_x))
+        return guess.ravel()
+
+    def warm_start_from_fits(self, fits):
+        """
+        Initial guess of every subregion from its own logistic fit: a list of Fit (after
+        fit_logistic) or a Batch_Fit table, in the order of data_x. The subregions whose fit
+        failed keep the current initial guess.
+        """
+        if isinstance(fits, pd.DataFrame):
+            fitted = fits[["a", "b", "c"]].to_numpy(dtype=float)
+        else:
+            fitted = [np.asarray(fit.fitted_params[: self.nb_vars], dtype=float) for fit in fits]
+
+        guess = self._initial_guess_vector().reshape(-1, self.nb_vars)
+        for i, params in enumerate(fitted):
+            if len(params) == self.nb_vars and np.all(np.isfinite(params)):
+                guess[i] = params
+
+        lower, upper = bounds_arrays(self.bounds)
+        self.initial_guess = np.clip(guess, lower, upper).tolist()
+
+    def warm_start_from_solution(self, solution):
+        """
+        Initial guess from a previous solution, e.g. the previous epoch: an opt.x or an
+        optimized RegionalFit with the same subregions.
+        """
+        if isinstance(solution, RegionalFit):
+            solution = solution.opt.x
+        self.initial_guess = np.asarray(solution, dtype=float).reshape(-1, self.nb_vars).tolist()
+
+    def constraint_violation(self, vars):
+        values = self.constraint_values(vars)
+        lower, upper = self.constraint_bounds()
+        return np.max(np.maximum(lower - values, values - upper), initial=0.0)
+
+    def _starts(self, n_starts, method, spread, seed):
+        # the first start is always the initial guess
+        initial_guess = self._initial_guess_vector()
+        lower, upper = bounds_arrays(self.bounds * len(self.data_x))
+        rng = np.random.default_rng(seed)
+
+        if method == "lhs":
+            box_lower = np.clip(initial_guess * (1 - spread), lower, upper)
+            box_upper = np.clip(initial_guess * (1 + spread), lower, upper)
+            sample = qmc.LatinHypercube(d=len(initial_guess), seed=rng).random(n_starts - 1)
+            starts = box_lower + sample * (box_upper - box_lower)
+        elif method == "perturb":
+            noise = rng.standard_normal((n_starts - 1, len(initial_guess)))
+            starts = np.clip(initial_guess * np.exp(spread * noise), lower, upper)
+        else:
+            print("Start method ", method, " not recognised, use lhs or perturb")
+            sys.exit()
+
+        return np.vstack([initial_guess, starts])
+
+    def optimize_multistart(
+        self, n_starts=8, method="lhs", spread=0.5, solver="SLSQP", options=None, max_workers=max_workers, seed=0, feasibility_tol=1e-6
+    ):
+        """
+        Runs the optimization from n_starts starting points (the initial guess, then Latin
+        hypercube samples or random perturbations within +/- spread of it) in a pool of
+        processes, and keeps the feasible solution with the lowest objective, or the least
+        infeasible one. The report of every start is kept in starts_report. Raises a
+        RuntimeError if no start returned a solution.
+        """
+        if solver not in solvers:
+            print("Solver ", solver, " not recognised, use one of ", list(solvers))
+            sys.exit()
+
+        self.define_constraints()
+        bounds = self.bounds * len(self.data_x)
+        starts = self._starts(n_starts, method, spread, seed)
+        # no solver output from every start, the starts are summed up in starts_report
+        options = {"disp": False, **(options or {})}
+
+        if max_workers <= 1:
+            results = [_run_start(self, i, start, bounds, solver, options) for i, start in enumerate(starts)]
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                results = list(
+                    executor.map(
+                        _run_start,
+                        [self] * len(starts),
+                        range(len(starts)),
+                        starts,
+                        [bounds] * len(starts),
+                        [solver] * len(starts),
+                        [options] * len(starts),
+                    )
+                )
+
+        tolerance = feasibility_tol * max(np.max(np.abs(self.points_y)), 1)
+        report = []
+        for start, opt, seconds, error in results:
+            violation = self.constraint_violation(opt.x) if opt is not None else np.inf
+            report.append(
+                {
+                    "start": start,
+                    "success": opt is not None and bool(opt.success),
+                    "feasible": violation <= tolerance,
+                    "fun": opt.fun if opt is not None else np.nan,
+                    "violation": violation,
+                    "seconds": seconds,
+                    "message": error if opt is None else str(opt.message),
+                }
+            )
+        self.starts_report = pd.DataFrame(report)
+
+        if all(opt is None for _, opt, _, _ in results):
+            raise RuntimeError(
+                f"{self.name}: all the {len(starts)} starts failed, first error: {self.starts_report['message'].iloc[0]}"
+            )
+
+        # feasible first, then the lowest objective, or the lowest violation if none is feasible
+        ranking = self.starts_report.assign(
+            key=np.where(self.starts_report["feasible"], self.starts_report["fun"], np.inf)
+        ).sort_values(["key", "violation"])
+        best = ranking.iloc[0]
+        self.opt = results[int(best["start"])][1]
+
+        print(
+            f"{self.name}: {int(self.starts_report['feasible'].sum())}/{len(starts)} feasible starts, "
+            f"best start {int(best['start'])} with objective {best['fun']} and violation {best['violation']}"
+        )
+        return self.starts_report
+
     def plot(self):
         guessed_logistic = np.zeros_like(self.parent_x)  # Initialize as array instead of list
 
@@ -0,0 +1,175 @@
+import numpy as np
+from scipy.optimize import Bounds, NonlinearConstraint, OptimizeResult, minimize
+from scipy.sparse import diags
+from scipy.sparse.linalg import LinearOperator
+
+# Solver backends of RegionalFit.optimize. A backend is called with the RegionalFit (with its
+# constraints defined), the initial guess, the bounds as a list of (min, max) and an options
+# dict, and returns a scipy OptimizeResult whose fun is the RMSE objective.
+# The trust-constr and augmented Lagrangian backends only use sparse, block diagonal
+# constraint Jacobians and Hessians (the constraints of a subregion only involve its own 3
+# parameters), and work on parameters scaled by the initial guess, since they span from 1e-4
+# to 1e4.
+
+
+def bounds_arrays(bounds):
+    lower = np.array([-np.inf if lo is None else lo for lo, _ in bounds], dtype=float)
+    upper = np.array([np.inf if hi is None else hi for _, hi in bounds], dtype=float)
+    return lower, upper
+
+
+def _scale(initial_guess):
+    scale = np.abs(np.asarray(initial_guess, dtype=float))
+    return np.where(scale > 0, scale, 1.0)
+
+
+def _y_scale(regional_fit):
+    return max(np.max(np.abs(regional_fit.parent_y)), np.max(np.abs(regional_fit.points_y)), 1e-12)
+
+
+def solve_slsqp(regional_fit, initial_guess, bounds, options):
+    return minimize(
+        regional_fit.objective,
+        initial_guess,
+        jac=regional_fit.objective_gradient,
+        bounds=bounds,
+        constraints=regional_fit.constraints,
+        method="SLSQP",
+        options={"maxiter": 10000, "disp": True, **options},
+    )
+
+
+def solve_trust_constr(regional_fit, initial_guess, bounds, options):
+    """
+    Interior point trust-region method with sparse constraint Jacobian and Hessian. The
+    objective is half the MSE (same minimum as the RMSE) with a Gauss-Newton Hessian.
+    """
+    scale = _scale(initial_guess)
+    D = diags(scale)
+    nb_points = len(regional_fit.parent_x)
+
+    def fun(z):
+        residuals, _, _ = regional_fit._parent_residuals(z * scale)
+        return 0.5 * np.mean(residuals**2)
+
+    def grad(z):
+        x = z * scale
+        residuals, _, _ = regional_fit._parent_residuals(x)
+        return scale * (regional_fit.parent_residuals_jacobian(x).T @ residuals) / nb_points
+
+    def hess(z):
+        jac = regional_fit.parent_residuals_jacobian(z * scale) * scale
+        return LinearOperator((len(z), len(z)), matvec=lambda p: jac.T @ (jac @ p) / nb_points)
+
+    lower, upper = regional_fit.constraint_bounds()
+    constraint = NonlinearConstraint(
+        lambda z: regional_fit.constraint_values(z * scale),
+        lower,
+        upper,
+        jac=lambda z: regional_fit.constraint_jacobian_sparse(z * scale) @ D,
+        hess=lambda z, v: D @ regional_fit.constraint_hessian(z * scale, v) @ D,
+    )
+
+    lo, hi = bounds_arrays(bounds)
+    result = minimize(
+        fun,
+        initial_guess / scale,
+        jac=grad,
+        hess=hess,
+        bounds=Bounds(lo / scale, hi / scale),
+        constraints=[constraint],
+        method="trust-constr",
+        options={"maxiter": 10000, "sparse_jacobian": True, **options},
+    )
+    result.x = result.x * scale
+    result.fun = regional_fit.objective(result.x)
+    return result
+
+
+def solve_augmented_lagrangian(regional_fit, initial_guess, bounds, options):
+    """
+    Augmented Lagrangian on the constraints lower <= c(x) <= upper, each subproblem being
+    solved by L-BFGS-B within the parameter bounds. Options: max_outer, inner_maxiter,
+    penalty (initial), max_penalty, feasibility_tol (relative to the data).
+    """
+    max_outer = options.get("max_outer", 50)
+    inner_maxiter = options.get("inner_maxiter", 1000)
+    penalty = options.get("penalty", 10.0)
+    max_penalty = options.get("max_penalty", 1e8)
+    feasibility_tol = options.get("feasibility_tol", 1e-6)
+
+    scale = _scale(initial_guess)
+    nb_points = len(regional_fit.parent_x)
+
+    # the objective and the constraints are normalized by the magnitude of the data
+    y_scale = _y_scale(regional_fit)
+    lower, upper = regional_fit.constraint_bounds()
+    lower, upper = lower / y_scale, upper / y_scale
+    multipliers = np.zeros(len(lower))
+
+    def lagrangian(z, multipliers, penalty):
+        x = z * scale
+        residuals, _, _ = regional_fit._parent_residuals(x)
+        residuals = residuals / y_scale
+        value = 0.5 * np.mean(residuals**2)
+        grad = regional_fit.parent_residuals_jacobian(x).T @ residuals / (nb_points * y_scale)
+
+        # shifted constraints projected on their bounds
+        shifted = regional_fit.constraint_values(x) / y_scale + multipliers / penalty
+        excess = shifted - np.clip(shifted, lower, upper)
+        value += 0.5 * penalty * np.sum(excess**2) - np.sum(multipliers**2) / (2 * penalty)
+        grad = grad + regional_fit.constraint_jacobian_sparse(x).T @ (penalty * excess) / y_scale
+
+        return value, grad * scale
+
+    lo, hi = bounds_arrays(bounds)
+    z_bounds = list(zip(lo / scale, hi / scale))
+    z = initial_guess / scale
+
+    nit = 0
+    violation = np.inf
+    previous_violation = np.inf
+    inner = None
+    for _ in range(max_outer):
+        inner = minimize(
+            lagrangian,
+            z,
+            args=(multipliers, penalty),
+            jac=True,
+            bounds=z_bounds,
+            method="L-BFGS-B",
+            # the normalized Lagrangian is small, only stop on the projected gradient
+            options={"maxiter": inner_maxiter, "ftol": 1e-15, "gtol": feasibility_tol},
+        )
+        z = inner.x
+        nit += inner.nit
+
+        values = regional_fit.constraint_values(z * scale) / y_scale
+        shifted = values + multipliers / penalty
+        multipliers = penalty * (shifted - np.clip(shifted, lower, upper))
+
+        violation = np.max(np.abs(values - np.clip(values, lower, upper)), initial=0)
+        if violation <= feasibility_tol:
+            break
+        if violation > 0.25 * previous_violation:
+            penalty = min(10 * penalty, max_penalty)
+        previous_violation = violation
+
+    success = violation <= feasibility_tol and inner is not None and inner.success
+    x = z * scale
+    return OptimizeResult(
+        x=x,
+        fun=regional_fit.objective(x),
+        success=success,
+        status=0 if success else 1,
+        message="Converged" if success else f"Constraint violation {violation:.3g} after {max_outer} iterations",
+        nit=nit,
+        constr_violation=violation * y_scale,
+    )
+
+
+solvers = {
+    "SLSQP": solve_slsqp,
+    "trust-constr": solve_trust_constr,
+    "augmented-lagrangian": solve_augmented_lagrangian,
+}
@@ -0,0 +1,160 @@
+import os
+import threading
+import time
+import uuid
+from urllib.parse import quote
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# rows kept in memory before being written as a new Parquet part
+buffer_rows = 100000
+
+schema = pa.schema(
+    [
+        ("region", pa.string()),
+        ("year", pa.int32()),
+        ("variable", pa.string()),
+        ("value", pa.float64()),
+        ("written", pa.int64()),  # time of the write, the last one wins on a (region, year, variable) key
+    ]
+)
+key_cols = ["product", "parent", "region", "year", "variable"]
+
+
+class Result_Store:
+    """
+    Columnar store of the observables computed per subregion, replacing one CSV per subregion.
+    Long rows (region, year, variable, value) are saved as Parquet files partitioned by product
+    and parent: <root>/product=<product>/parent=<parent>/part-*.parquet.
+    Appending the same (region, year, variable) again is an upsert: reads keep the last value.
+    """
+
+    def __init__(self, root: str, buffer_rows=buffer_rows):
+        self.root = root
+        self.buffer_rows = buffer_rows
+        self._buffer = {}  # (product, parent) -> list of DataFrames
+        self._buffered_rows = 0
+        self._regions = {}  # (product, parent) -> set of regions already stored
+        self._lock = threading.RLock()  # the preprocessing appends from a thread pool
+
+    def _partition_path(self, product: str, parent: str):
+        return os.path.join(self.root, f"product={quote(product, safe='')}", f"parent={quote(parent, safe='')}")
+
+    def append(self, product: str, parent: str, region: str, output_df):
+        """
+        Adds the wide output_df of one region (a "year" column and one column per variable).
+        Values without a "year" column (e.g. OSM areas) are stored with a null year.
+        """
+        if "year" in output_df.columns:
+            long_df = output_df.melt(id_vars="year", var_name="variable", value_name="value")
+        else:
+            long_df = output_df.melt(var_name="variable", value_name="value").assign(year=None)
+        long_df.insert(0, "region", str(region))
+        self.append_long(product, parent, long_df)
+
+    def append_long(self, product: str, parent: str, long_df):
+        long_df = pd.DataFrame(
+            {
+                "region": long_df["region"].astype(str),
+                "year": pd.to_numeric(long_df["year"], errors="coerce").astype("Int32"),
+                "variable": long_df["variable"].astype(str),
+                "value": pd.to_numeric(long_df["value"], errors="coerce").astype(float),
+                "written": time.time_ns(),
+            }
+        )
+
+        with self._lock:
+            self._buffer.setdefault((product, parent), []).append(long_df)
+            self._buffered_rows += len(long_df)
+            self._known_regions(product, parent).update(long_df["region"])
+            if self._buffered_rows >= self.buffer_rows:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        for (product, parent), dfs in self._buffer.items():
+            table = pa.Table.from_pandas(pd.concat(dfs, ignore_index=True), schema=schema, preserve_index=False)
+            path = self._partition_path(product, parent)
+            os.makedirs(path, exist_ok=True)
+            pq.write_table(table, os.path.join(path, f"part-{time.time_ns()}-{uuid.uuid4().hex}.parquet"))
+
+        self._buffer = {}
+        self._buffered_rows = 0
+
+    def _known_regions(self, product: str, parent: str):
+        if (product, parent) not in self._regions:
+            regions = set()
+            path = self._partition_path(product, parent)
+            if os.path.isdir(path):
+                regions.update(ds.dataset(path, format="parquet").to_table(columns=["region"]).column("region").to_pylist())
+            self._regions[(product, parent)] = regions
+        return self._regions[(product, parent)]
+
+    def has(self, product: str, parent: str, region: str):
+        with self._lock:
+            return str(region) in self._known_regions(product, parent)
+
+    def _dataset(self):
+        partitioning = ds.partitioning(pa.schema([("product", pa.string()), ("parent", pa.string())]), flavor="hive")
+        return ds.dataset(self.root, format="parquet", partitioning=partitioning)
+
+    def read(self, products=None, parents=None, regions=None, years=None, variables=None):
+        """
+        Long DataFrame of the stored values. The filters are pushed down to the Parquet scan,
+        so only the matching partitions and row groups are read. The values still buffered by
+        append are not read: call flush after a batch of writes.
+        """
+        if not os.path.isdir(self.root):
+            return pd.DataFrame(columns=key_cols + ["value"])
+
+        filters = []
+        for col, values in [("product", products), ("parent", parents), ("region", regions), ("variable", variables)]:
+            if values is not None:
+                filters.append(ds.field(col).isin([str(v) for v in values]))
+        if years is not None:
+            # the values stored without a year (e.g. OSM areas) are valid for every year
+            filters.append(ds.field("year").isin([int(y) for y in years]) | ds.field("year").is_null())
+
+        expression = None
+        for f in filters:
+            expression = f if expression is None else expression & f
+
+        df = self._dataset().to_table(filter=expression).to_pandas()
+
+        # upsert: the last write of a key wins
+        df = df.sort_values("written", kind="stable").drop_duplicates(key_cols, keep="last")
+        return df[key_cols + ["value"]].reset_index(drop=True)
+
+    def read_wide(self, products=None, parents=None, regions=None, years=None):
+        """
+        One row per (product, parent, region, year) and one column per variable.
+        """
+        df = self.read(products=products, parents=parents, regions=regions, years=years)
+        # groupby keeps the rows stored without a year
+        wide = df.groupby(key_cols, dropna=False)["value"].last().unstack("variable")
+        wide.columns.name = None
+        return wide.reset_index()
+
+    def compact(self):
+        """
+        Rewrites every partition as a single Parquet file without the overwritten values.
+        """
+        with self._lock:
+            self._flush()
+            df = self.read()
+            for (product, parent), partition in df.groupby(["product", "parent"]):
+                path = self._partition_path(product, parent)
+                old_parts = [os.path.join(path, f) for f in os.listdir(path) if f.endswith(".parquet")]
+
+                partition = partition.drop(columns=["product", "parent"]).assign(written=time.time_ns())
+                table = pa.Table.from_pandas(partition, schema=schema, preserve_index=False)
+                pq.write_table(table, os.path.join(path, f"part-{time.time_ns()}-{uuid.uuid4().hex}.parquet"))
+
+                for part in old_parts:
+                    os.remove(part)
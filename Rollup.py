@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+
+
+class Rollup:
+    """
+    Declarative aggregation of subregion values into their parents:
+    - sums: extensive columns, summed (population, surfaces, ...)
+    - weighted_means: intensive columns -> weight column, e.g. {"GDP per capita": "Population_OECD"}
+    - ratios: columns computed after aggregation -> (numerator column, denominator column)
+    """
+
+    def __init__(self, sums=(), weighted_means=None, ratios=None):
+        self.sums = list(sums)
+        self.weighted_means = dict(weighted_means or {})
+        self.ratios = dict(ratios or {})
+
+    def aggregate(self, long_df, group_cols: list):
+        """
+        One row per group of long_df, computed with grouped reductions only.
+        """
+        work = long_df[group_cols].copy()
+        for col in self.sums:
+            work[col] = pd.to_numeric(long_df[col], errors="coerce")
+
+        for col, weight_col in self.weighted_means.items():
+            values = pd.to_numeric(long_df[col], errors="coerce")
+            weights = pd.to_numeric(long_df[weight_col], errors="coerce")
+            valid = values.notna() & weights.notna()
+            work[col + " x weight"] = (values * weights).where(valid)
+            work[col + " weight"] = weights.where(valid)
+
+        grouped = work.groupby(group_cols, sort=False).sum(min_count=1)
+
+        out = grouped[self.sums].copy()
+        for col in self.weighted_means:
+            out[col] = grouped[col + " x weight"] / grouped[col + " weight"].replace(0, np.nan)
+        for col, (numerator, denominator) in self.ratios.items():
+            out[col] = out[numerator] / out[denominator].replace(0, np.nan)
+
+        return out.reset_index()
+
+    def rollup(self, long_df, ancestors: dict, region_col="region", year_col="year"):
+        """
+        Aggregates the leaf rows of long_df (one per leaf region and year) into all their
+        ancestors at once. ancestors maps each leaf region to the list of its ancestors,
+        whatever the number of levels. Returns one row per (ancestor, year).
+        """
+        pairs = pd.DataFrame(
+            [(leaf, ancestor) for leaf, leaf_ancestors in ancestors.items() for ancestor in leaf_ancestors],
+            columns=[region_col, "ancestor"],
+        )
+        expanded = long_df.merge(pairs, on=region_col, how="inner")
+        expanded = expanded.drop(columns=region_col).rename(columns={"ancestor": region_col})
+
+        return self.aggregate(expanded, [region_col, year_col])
+
+
+# aggregation used by Region.compute_own_df for the GHSL and OECD observables
+GHSL_OECD_rollup = Rollup(
+    sums=["Population_OECD", "Population_GHSL", "Built up surface GHSL", "Total surface"],
+    weighted_means={"GDP per capita": "Population_OECD"},
+    ratios={
+        "Built up surface GHSL/Population_OECD": ("Built up surface GHSL", "Population_OECD"),
+        "Population_OECD/Total surface": ("Population_OECD", "Total surface"),
+        "Built up surface GHSL/Population_GHSL": ("Built up surface GHSL", "Population_GHSL"),
+        "Population_GHSL/Total surface": ("Population_GHSL", "Total surface"),
+    },
+)
@@ -0,0 +1,111 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+
+class Stat_Source:
+    """
+    Statistical source (DOSE, UCDB sheets, OECD tables) loaded once into a float table indexed
+    by (region, year), so that the values of many regions, years and variables are extracted
+    by a single join instead of one boolean filter per value.
+    Values without a year (e.g. the UCDB _2025 columns) are given static_year when loaded.
+    """
+
+    def __init__(self, table: pd.DataFrame, name=""):
+        self.name = name
+        self.table = table.sort_index()
+
+    @classmethod
+    def from_long(cls, df, region_col: str, year_col: str, columns=None, variable_col=None, value_col=None, name=""):
+        """
+        One row per (region, year): the variables are columns, or are given by variable_col
+        and value_col (OECD style), in which case they are pivoted.
+        """
+        if variable_col is not None:
+            if columns is not None:
+                df = df[df[variable_col].isin(columns)]
+            df = df.pivot_table(index=[region_col, year_col], columns=variable_col, values=value_col, aggfunc="last")
+            df.columns.name = None
+            df = df.reset_index()
+        columns = [c for c in df.columns if c not in (region_col, year_col)] if columns is None else list(columns)
+
+        table = df[columns].apply(pd.to_numeric, errors="coerce").astype(float)
+        table.index = pd.MultiIndex.from_arrays(
+            [df[region_col].astype(str), pd.to_numeric(df[year_col]).astype(int)], names=["region", "year"]
+        )
+        # the last row of a duplicated (region, year) wins
+        table = table[~table.index.duplicated(keep="last")]
+        return cls(table, name)
+
+    @classmethod
+    def from_wide(cls, df, region_col: str, columns, static_year=None, name=""):
+        """
+        One row per region (UCDB style): a variable is either a column per year, named
+        <variable>_<year>, or a single column given static_year.
+        """
+        df = df.drop_duplicates(region_col, keep="last")
+        regions = df[region_col].astype(str).to_numpy()
+
+        yearly = {}
+        for col in df.columns:
+            match = re.fullmatch(r"(.+)_(\d{4})", str(col))
+            if match and match.group(1) in columns:
+                yearly.setdefault(match.group(1), []).append((int(match.group(2)), col))
+
+        parts = []
+        for variable in columns:
+            if variable in df.columns and static_year is not None:
+                pairs = [(static_year, variable)]
+            else:
+                pairs = yearly.get(variable, [])
+            for year, col in pairs:
+                parts.append(
+                    pd.DataFrame(
+                        {
+                            "region": regions,
+                            "year": year,
+                            "variable": variable,
+                            "value": pd.to_numeric(df[col], errors="coerce").to_numpy(dtype=float),
+                        }
+                    )
+                )
+        if not parts:
+            print(f"None of the columns were found in {name}.")
+            return cls(pd.DataFrame(index=pd.MultiIndex.from_arrays([[], []], names=["region", "year"])), name)
+
+        long_df = pd.concat(parts, ignore_index=True)
+        table = long_df.pivot_table(index=["region", "year"], columns="variable", values="value", aggfunc="last")
+        table.columns.name = None
+        return cls(table.reindex(columns=[c for c in columns if c in table.columns]), name)
+
+    def join(self, other, name=None):
+        """
+        Both sources in one table, on the union of their (region, year).
+        """
+        table = self.table.join(other.table, how="outer", rsuffix="_" + (other.name or "other"))
+        return Stat_Source(table, self.name if name is None else name)
+
+    @property
+    def columns(self):
+        return self.table.columns.to_list()
+
+    def lookup(self, regions, years, columns=None, year_map=None):
+        """
+        Values of every (region, year) of regions x years, NaN if missing, as a DataFrame with
+        region and year columns. year_map replaces the year looked up, e.g. {2020: 2018} when a
+        source stops earlier; the requested year is kept in the output.
+        """
+        columns = self.columns if columns is None else list(columns)
+        years = [int(y) for y in years]
+        source_years = [int((year_map or {}).get(y, y)) for y in years]
+
+        regions = np.asarray([str(r) for r in regions])
+        index = pd.MultiIndex.from_arrays(
+            [np.repeat(regions, len(years)), np.tile(source_years, len(regions))], names=["region", "year"]
+        )
+        values = self.table.reindex(index=index, columns=columns)
+        values.index = pd.MultiIndex.from_arrays(
+            [index.get_level_values("region"), np.tile(years, len(regions))], names=["region", "year"]
+        )
+        return values.reset_index()
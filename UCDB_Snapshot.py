@@ -0,0 +1,104 @@
+import os
+import re
+import threading
+
+import pandas as pd
+import pyarrow as pa
+
+from Memo_Cache import file_identity
+
+ucdb_sheets = ["GHSL", "SOCIOECONOMIC", "EMISSIONS", "CLIMATE", "INFRASTRUCTURES"]
+
+
+def _typed(df):
+    """
+    Columns that Arrow can store: numeric when they all parse, strings otherwise.
+    """
+    df = df.copy()
+    for col in df.columns:
+        if df[col].dtype == object:
+            numeric = pd.to_numeric(df[col], errors="coerce")
+            if numeric.notna().sum() == df[col].notna().sum():
+                df[col] = numeric
+            else:
+                df[col] = df[col].astype("string")
+    df.columns = [str(col) for col in df.columns]
+    return df
+
+
+class UCDB_Snapshot:
+    """
+    The sheets of the GHS UCDB workbook, parsed from Excel only once: they are saved as
+    uncompressed Arrow files in <folder>/<sha1 of the workbook>/<sheet>.arrow, which later runs
+    memory-map instead of reading the workbook. A new workbook gets a new snapshot.
+    The sheets stay Arrow tables backed by the memory map: only the columns asked to sheet()
+    are copied into pandas.
+    """
+
+    def __init__(self, workbook: str, folder=None, sheets=ucdb_sheets):
+        self.workbook = workbook
+        self.sheet_names = list(sheets)
+        folder = folder if folder is not None else os.path.join(os.path.dirname(workbook), "snapshot")
+
+        self.checksum = file_identity(workbook, checksum=True)["sha1"]
+        self.folder = os.path.join(folder, self.checksum)
+        self._tables = {}
+        self._sheets = {}
+        self._lock = threading.Lock()
+
+        if not all(os.path.isfile(self._path(name)) for name in self.sheet_names):
+            self._ingest()
+
+    def _path(self, sheet_name: str):
+        return os.path.join(self.folder, sheet_name + ".arrow")
+
+    def _ingest(self):
+        print("Parsing the UCDB workbook ", self.workbook)
+        # all the sheets in one pass over the workbook
+        try:
+            sheets = pd.read_excel(self.workbook, sheet_name=self.sheet_names, engine="calamine")
+        except ImportError:
+            sheets = pd.read_excel(self.workbook, sheet_name=self.sheet_names)
+
+        os.makedirs(self.folder, exist_ok=True)
+        for name, df in sheets.items():
+            table = pa.Table.from_pandas(_typed(df), preserve_index=False)
+            tmp_path = f"{self._path(name)}.{os.getpid()}.tmp"
+            with pa.OSFile(tmp_path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+            os.replace(tmp_path, self._path(name))
+
+    def table(self, sheet_name: str):
+        """
+        Arrow table of a sheet, memory-mapped (no copy, the pages are read when used).
+        """
+        with self._lock:
+            if sheet_name not in self._tables:
+                self._tables[sheet_name] = pa.ipc.open_file(pa.memory_map(self._path(sheet_name), "r")).read_all()
+            return self._tables[sheet_name]
+
+    def variable_columns(self, sheet_name: str, variables):
+        """
+        Columns of a sheet holding the variables: named <variable> or <variable>_<year>.
+        """
+        return [
+            col
+            for col in self.table(sheet_name).column_names
+            if col in variables or (re.fullmatch(r"(.+)_(\d{4})", col) and col.rsplit("_", 1)[0] in variables)
+        ]
+
+    def sheet(self, sheet_name: str, columns=None):
+        """
+        DataFrame of the given columns of a sheet (all of them by default, i.e. a copy of the
+        whole sheet in memory). It is converted once per snapshot and columns, the same object
+        being returned after, so that Admin_Index.of can share its index.
+        """
+        key = (sheet_name, None if columns is None else tuple(columns))
+        table = self.table(sheet_name)
+        with self._lock:
+            if key not in self._sheets:
+                self._sheets[key] = (table if columns is None else table.select(list(columns))).to_pandas()
+            return self._sheets[key]
+
+    def __getitem__(self, sheet_name: str):
+        return self.sheet(sheet_name)
@@ -0,0 +1,187 @@
+import hashlib
+from contextlib import ExitStack
+
+import numpy as np
+import pandas as pd
+import rasterio
+import shapely
+from rasterio.features import geometry_mask
+from rasterio.windows import Window, from_bounds
+from shapely.geometry import box
+
+from Memo_Cache import file_identity
+from Raster_Windows import accumulator_dtype, iter_windows, max_window_memory
+
+
+def same_grid(src_a, src_b):
+    return (
+        src_a.crs == src_b.crs
+        and src_a.transform == src_b.transform
+        and src_a.shape == src_b.shape
+    )
+
+
+class Zonal_Stats:
+    """
+    Computes sum, valid pixel count, mean, min and max of a raster for every polygon of an
+    admin units GeoDataFrame. The raster is read once, by block-aligned windows, and no intermediate
+    raster is written on disk. Multipolygons are handled part by part, so that a country with
+    overseas territories only rasterizes its parts in the windows they touch.
+    """
+
+    def __init__(self, gpd_admin_units, region_col: str):
+        self.region_col = region_col
+        self.admin_units = gpd_admin_units.loc[
+            ~gpd_admin_units.geometry.isnull(), [region_col, "geometry"]
+        ].reset_index(drop=True)
+
+    def _admin_units_for(self, src):
+        # Ensure the admin units are in the same coordinate system as the raster
+        if self.admin_units.crs is not None and self.admin_units.crs != src.crs:
+            return self.admin_units.to_crs(src.crs)
+        return self.admin_units
+
+    def compute(self, raster_file, band=1, max_memory=max_window_memory, memo_cache=None):
+        return self.compute_many([raster_file], band=band, max_memory=max_memory, memo_cache=memo_cache)[0]
+
+    def compute_many(self, raster_files, band=1, max_memory=max_window_memory, memo_cache=None):
+        """
+        Statistics of several co-registered rasters (same CRS, transform and shape) in a
+        single windowed pass: the polygon masks are computed once per window and shared by
+        all the rasters. Returns one DataFrame per raster, in the same order.
+        With a Memo_Cache, the statistics are cached in one entry per raster file (a dict by
+        polygon WKB hash) and only the polygons that are new or changed are computed.
+        """
+        if not raster_files:
+            return []
+
+        with ExitStack() as stack:
+            sources = [stack.enter_context(rasterio.open(file)) for file in raster_files]
+            src = sources[0]
+            for other in sources[1:]:
+                if not same_grid(src, other):
+                    print("The rasters ", src.name, " and ", other.name, " are not on the same grid.")
+                    return None
+
+            admin_units = self._admin_units_for(src)
+            geometries = admin_units.geometry.values
+
+            nb_regions = len(admin_units)
+            sums = [np.zeros(nb_regions, dtype=accumulator_dtype(s.dtypes[band - 1])) for s in sources]
+            counts = [np.zeros(nb_regions, dtype=np.int64) for _ in sources]
+            mins = [np.full(nb_regions, np.inf) for _ in sources]
+            maxs = [np.full(nb_regions, -np.inf) for _ in sources]
+
+            todo = np.arange(nb_regions)
+            if memo_cache is not None:
+                todo, keys, entries, hashes = self._read_cache(memo_cache, raster_files, geometries, band, sums, counts, mins, maxs)
+
+            # parts of the polygons to compute, the unit of every part and their spatial index
+            parts, part_idx = shapely.get_parts(geometries[todo], return_index=True)
+            part_units = todo[part_idx]
+            sindex = shapely.STRtree(parts)
+
+            # pixel values and nodata masks of every raster, plus the geometry mask
+            bytes_per_pixel = sum(np.dtype(s.dtypes[band - 1]).itemsize + 1 for s in sources) + 1
+            for window in iter_windows(src, band, max_memory, bytes_per_pixel) if len(todo) else []:
+                # only the polygon parts touching this window are rasterized
+                hits = sindex.query(box(*src.window_bounds(window)), predicate="intersects")
+                if len(hits) == 0:
+                    continue
+
+                window_data = []
+                for s in sources:
+                    data = s.read(band, window=window, masked=True)
+                    window_data.append((data.data, ~np.ma.getmaskarray(data)))
+                if not any(valid.any() for _, valid in window_data):
+                    continue
+
+                for j in hits:
+                    i = part_units[j]
+                    # restrict the mask to the part of the window covered by the polygon part
+                    rows, cols = self._polygon_slices(src, window, parts[j])
+                    if rows is None:
+                        continue
+                    inside = geometry_mask(
+                        [parts[j]],
+                        out_shape=(rows.stop - rows.start, cols.stop - cols.start),
+                        transform=src.window_transform(
+                            Window(
+                                window.col_off + cols.start,
+                                window.row_off + rows.start,
+                                cols.stop - cols.start,
+                                rows.stop - rows.start,
+                            )
+                        ),
+                        invert=True,
+                    )
+
+                    for k, (data, valid) in enumerate(window_data):
+                        values = data[rows, cols][inside & valid[rows, cols]]
+                        if values.size == 0:
+                            continue
+
+                        sums[k][i] += values.sum(dtype=sums[k].dtype)
+                        counts[k][i] += values.size
+                        mins[k][i] = min(mins[k][i], values.min())
+                        maxs[k][i] = max(maxs[k][i], values.max())
+
+        if memo_cache is not None and len(todo):
+            for k in range(len(raster_files)):
+                entries[k].update({hashes[i]: (sums[k][i], counts[k][i], mins[k][i], maxs[k][i]) for i in todo})
+                memo_cache.put(keys[k], entries[k])
+
+        return [
+            self._to_df(admin_units, sums[k], counts[k], mins[k], maxs[k])
+            for k in range(len(raster_files))
+        ]
+
+    def _read_cache(self, memo_cache, raster_files, geometries, band, sums, counts, mins, maxs):
+        """
+        Fills the accumulators with the cached statistics and returns the indices of the
+        polygons still to compute, with the cache key and the cached entry of every raster and
+        the hash of every polygon.
+        """
+        hashes = [hashlib.sha1(wkb).hexdigest() for wkb in shapely.to_wkb(geometries)]
+        keys = [memo_cache.key("zonal_stats", raster=file_identity(file), band=band) for file in raster_files]
+        entries = [memo_cache.get(key, {}) for key in keys]
+
+        todo = []
+        for i, geometry_hash in enumerate(hashes):
+            if not all(geometry_hash in entry for entry in entries):
+                todo.append(i)
+                continue
+            for k, entry in enumerate(entries):
+                sums[k][i], counts[k][i], mins[k][i], maxs[k][i] = entry[geometry_hash]
+
+        return np.array(todo, dtype=np.int64), keys, entries, hashes
+
+    def _polygon_slices(self, src, window, geometry):
+        """
+        Row and column slices, relative to the window, of the pixels under the polygon bounds.
+        """
+        bounds = from_bounds(*geometry.bounds, transform=src.transform)
+        row_start = max(int(np.floor(bounds.row_off)) - int(window.row_off), 0)
+        col_start = max(int(np.floor(bounds.col_off)) - int(window.col_off), 0)
+        row_stop = min(int(np.ceil(bounds.row_off + bounds.height)) - int(window.row_off), int(window.height))
+        col_stop = min(int(np.ceil(bounds.col_off + bounds.width)) - int(window.col_off), int(window.width))
+
+        if row_start >= row_stop or col_start >= col_stop:
+            return None, None
+        return slice(row_start, row_stop), slice(col_start, col_stop)
+
+    def _to_df(self, admin_units, sums, counts, mins, maxs):
+        empty = counts == 0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            means = np.where(empty, np.nan, sums / np.maximum(counts, 1))
+
+        return pd.DataFrame(
+            {
+                self.region_col: admin_units[self.region_col].values,
+                "sum": sums,
+                "count": counts,
+                "mean": means,
+                "min": np.where(empty, np.nan, mins),
+                "max": np.where(empty, np.nan, maxs),
+            }
+        )
@@ -0,0 +1,104 @@
+import os
+import sys
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import box
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "utils"))
+import osm  # noqa: E402
+
+tag = "amenity"
+region = box(0, 0, 1, 1)
+
+
+def make_features(n=200, seed=0):
+    """
+    Point features indexed like osmnx by (element, id).
+    """
+    xy = np.random.default_rng(seed).random((n, 2))
+    index = pd.MultiIndex.from_arrays([["node"] * n, np.arange(n)], names=["element", "id"])
+    return gpd.GeoDataFrame({tag: "yes"}, index=index, geometry=gpd.points_from_xy(xy[:, 0], xy[:, 1]), crs="EPSG:4326")
+
+
+class Fake_Fetch:
+    """
+    Returns the features within the tile and records the tiles requested.
+    """
+
+    def __init__(self, features, fail_above=None):
+        self.features = features
+        self.fail_above = fail_above
+        self.calls = []
+
+    def __call__(self, polygon, tag):
+        self.calls.append(polygon.bounds)
+        features = self.features[self.features.intersects(polygon)]
+        if self.fail_above is not None and len(features) > self.fail_above:
+            raise RuntimeError("Overpass: too many features")
+        return features if not features.empty else None
+
+
+class Interrupt(BaseException):
+    pass
+
+
+def test_large_tiles_are_split(tmp_path):
+    features = make_features()
+    fetch = Fake_Fetch(features)
+
+    result = osm.fetch_adaptive(region, tag, str(tmp_path), fetch=fetch, max_features=50)
+
+    assert sorted(result.geometry.x) == sorted(features.geometry.x)
+    files = os.listdir(tmp_path)
+    assert "0.split" in files
+    assert not any(f == "0.parquet" for f in files)
+    assert any(f.endswith(".parquet") and len(f) > len("0.parquet") for f in files)
+    # a tile is only kept when it holds less than max_features
+    for f in files:
+        if f.endswith(".parquet"):
+            assert len(gpd.read_parquet(tmp_path / f)) < 50
+
+
+def test_failed_tiles_are_split(tmp_path):
+    features = make_features()
+    fetch = Fake_Fetch(features, fail_above=80)
+
+    result = osm.fetch_adaptive(region, tag, str(tmp_path), fetch=fetch, max_features=10**6)
+
+    assert len(result) == len(features)
+    assert (tmp_path / "0.split").is_file()
+
+
+def test_failure_at_max_depth_is_raised(tmp_path):
+    fetch = Fake_Fetch(make_features(), fail_above=0)
+
+    with pytest.raises(RuntimeError):
+        osm.fetch_adaptive(region, tag, str(tmp_path), fetch=fetch, max_depth=1)
+
+
+def test_interrupted_download_resumes(tmp_path):
+    features = make_features()
+    complete = Fake_Fetch(features)
+    expected = osm.fetch_adaptive(region, tag, str(tmp_path / "complete"), fetch=complete, max_features=50)
+
+    # the download stops after a few tiles
+    interrupted = Fake_Fetch(features)
+
+    def fetch_then_stop(polygon, tag):
+        if len(interrupted.calls) == 4:
+            raise Interrupt()
+        return interrupted(polygon, tag)
+
+    with pytest.raises(Interrupt):
+        osm.fetch_adaptive(region, tag, str(tmp_path / "resumed"), fetch=fetch_then_stop, max_features=50)
+
+    resumed = Fake_Fetch(features)
+    result = osm.fetch_adaptive(region, tag, str(tmp_path / "resumed"), fetch=resumed, max_features=50)
+
+    # the tiles finished or split before the interruption are not requested again
+    assert len(resumed.calls) == len(complete.calls) - len(interrupted.calls)
+    assert not set(resumed.calls) & set(interrupted.calls)
+    assert sorted(result.geometry.x) == sorted(expected.geometry.x)
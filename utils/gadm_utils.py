@@ -1,89 +1,34 @@
 # import fiona
 import rasterio
-from rasterio.mask import mask
 import geopandas as gpd
 
-from concurrent.futures import ThreadPoolExecutor
-import itertools
 import os 
 import sys
 
-max_workers = 12
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Admin_Store import Admin_Store
+from Clip_Executor import Clip_Executor
+from Raster_Mosaic import build_vrt, merge_rasters
 
-def create_country_mask_from_shapefile(
-    region, code: str, global_raster
-):
-    """
-    This function takes a GeoTIFF and a shapefile of administrative boundaries
-    and clip the original GTIFF file along one country boundaries. To specify a country, one can
-    provide its iso3 name.
-    """
-    output_file = output_path + getattr(region, code) + ".tif"  # Access attribute with getattr    
-    
-    if not os.path.isfile(output_file):
-        try:
-            print("Start ", getattr(region, code))
-            with rasterio.open(global_raster) as src:
-                out_image, out_transform = mask(src, [region.geometry], crop=True)
-                out_meta = src.meta.copy()  # copy the metadata of the source DEM
-
-                out_meta.update(
-                    {
-                        "driver": "Gtiff",
-                        "height": out_image.shape[1],  # height starts with shape[1]
-                        "width": out_image.shape[2],  # width starts with shape[2]
-                        "transform": out_transform,
-                        "dtype": out_image.dtype,
-                        "compress": "lzw",  # lossless compression algorithm
-                    }
-                )
-
-                
-                os.makedirs(os.path.dirname(output_file), exist_ok="True")
-                with rasterio.open(output_file, "w", **out_meta) as dest:
-                    dest.write(out_image)
-                    print("Success: ", output_file)
-        except Exception as e:
-            print(e)
-
-    else:
-        print("File already existing: ", output_file)
+max_workers = 12
 
-from rasterio.merge import merge
 import glob
 
 def merge_raster(folder:str, output_file:str):
+    """
+    Mosaic of the subregion TIFFs of a folder. A .vrt output_file is a virtual mosaic
+    referencing them (no pixel copied), otherwise a GeoTIFF written by bounded chunks.
+    """
     # Define a list of paths to the subnational TIFF files
-    tiff_files = glob.glob(folder+"*.tif")
-
-    # Open the TIFF files as datasets
-    datasets = [rasterio.open(tiff) for tiff in tiff_files]
+    tiff_files = sorted(glob.glob(folder+"*.tif"))
 
-    # Merge the datasets
-    merged_data, merged_transform = merge(datasets)
-
-    # Get metadata from the first file to use in the output
-    out_meta = datasets[0].meta.copy()
-
-    # Update metadata to match the merged raster
-    out_meta.update({
-        "driver": "GTiff",
-        "height": merged_data.shape[1],
-        "width": merged_data.shape[2],
-        "transform": merged_transform,
-        "dtype": merged_data.dtype,
-        "compress": "lzw",  # lossless compression algorithm
-    })
-
-    # Write the merged raster to a new file
-    with rasterio.open(output_file, "w", **out_meta) as dest:
-        dest.write(merged_data)
-
-    # Close the datasets
-    for dataset in datasets:
-        dataset.close()
+    if output_file.endswith(".vrt"):
+        merged = build_vrt(tiff_files, output_file)
+    else:
+        merged = merge_rasters(tiff_files, output_file)
 
-    print("Merged TIFF f'")
+    if merged is not None:
+        print("Merged TIFF files into ", output_file)
 
 
 ### MAIN
@@ -110,32 +55,19 @@ output_path = raster_path + "subregions/USA/"
 ###
 if __name__ == "__main__":
     print("Starting...")
-    # merge_raster(output_path+"USA/", output_path+"USA.tif")
+    # merge_raster(output_path+"USA/", output_path+"USA.vrt")
     # sys.exit()
     ###
-    regions_gpd = gpd.read_file(admin_units)
-
-    # regions_gpd = regions_gpd[regions_gpd["GID_0"] != "ATA"] # ignore antartica
-    regions_gpd = regions_gpd[regions_gpd["GID_0"] == "USA"]
-    regions_gpd = regions_gpd[~regions_gpd.geometry.isnull()]
-
-    with rasterio.open(global_raster) as src:
-        if regions_gpd.crs != src.crs:
-            print("Reshaping the admin units file to the same src CRS")
-            regions_gpd = regions_gpd.to_crs(src.crs)
-
-    # PARALLEL MODE
-    if mode == 0:
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            executor.map(create_country_mask_from_shapefile, regions_gpd.itertuples(), itertools.repeat(code), itertools.repeat(global_raster))
-   
-    # SERIAL MODE
-    elif mode == 1:        
-        for region in regions_gpd.itertuples():
-            try:
-                create_country_mask_from_shapefile(region, code, global_raster)
-            except Exception as err:
-                print("Error for : ", getattr(region, code))
-                print(f"Unexpected {err=}, {type(err)=}")
+    admin_store = Admin_Store(admin_units, data_folder + "Outputs/admin_store/", partition_col="GID_0")
+
+    # regions_gpd = admin_store.read(parents=[c for c in admin_store.parents() if c != "ATA"]) # ignore antartica
+    regions_gpd = admin_store.read(parents=["USA"])
+
+    # PARALLEL MODE (processes) or SERIAL MODE
+    executor = Clip_Executor(global_raster, max_workers=max_workers if mode == 0 else 1)
+    report = executor.run_gdf(regions_gpd, code, output_path)
+
+    print(report["status"].value_counts())
+    print("Total clipping time (s): ", report["seconds"].sum())
 
     print("Job done.")
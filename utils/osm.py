@@ -1,6 +1,7 @@
 import sys
 import os
 import shutil
+from datetime import date
 
 import geopandas as gpd
 import pandas as pd
@@ -10,8 +11,12 @@ from tqdm import tqdm  # Import the tqdm function from the tqdm module
 from concurrent.futures import ThreadPoolExecutor
 import itertools
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Memo_Cache import Memo_Cache
+
 ox.settings.requests_timeout = 72*3600
 ox.settings.memory_only = False
+ox.settings.use_cache = False  # the responses are cached by tile in osm_cache instead
 
 CRED = "\033[31m"
 CYEL = "\33[33m"
@@ -21,6 +26,30 @@ data_folder = "/data/mineralogie/hautervo/data/"
 max_workers = 4
 n_grid = 6
 
+# adaptive tiling: a tile is split in 4 when its request fails or returns at least
+# max_tile_features features, down to max_tile_depth
+max_tile_features = 50000
+max_tile_depth = 8
+
+# responses of the tiles, shared by the runs and the threads, keyed by (polygon, tags, date)
+osm_cache_folder = data_folder + "Outputs/OSM/cache/"
+osm_cache_size = 20 * 1024**3  # bytes, the least recently used tiles are evicted beyond
+# OSM is queried as of osm_date, so that the tiles cached by a run stay valid for the next ones
+# and an interrupted country resumes from the cache on any later day. None queries the current
+# data instead: the cache is then only reused on the same day (the date is part of the key).
+osm_date = "2026-01-01T00:00:00Z"
+if osm_date is not None:
+    ox.settings.overpass_settings = '[out:json][timeout:{timeout}]{maxsize}[date:"' + osm_date + '"]'
+osm_cache = Memo_Cache(osm_cache_folder, max_size=osm_cache_size)
+
+# geometry types kept for a tag, the others are dropped as soon as a tile arrives
+geometry_types = {
+    "building": ["Polygon", "MultiPolygon"],
+    "landuse": ["Polygon", "MultiPolygon"],
+    "highway": ["LineString", "MultiLineString"],
+    "route": ["LineString", "MultiLineString"],
+}
+
 
 ###
 def create_grid(geometry, n_rows, n_cols):
@@ -53,9 +82,100 @@ def create_grid(geometry, n_rows, n_cols):
     
     return grid_polygons
 
+def split_tile(geometry):
+    """
+    The non-empty intersections of the geometry with the 4 quadrants of its bounding box.
+    """
+    return [(str(i), cell) for i, cell in enumerate(create_grid(geometry, n_rows=2, n_cols=2))]
+
+def _process_tile(tile, tag, fetch, checkpoint_folder, max_features, max_depth):
+    """
+    Returns the features of a tile, or None and its children if it has to be split.
+    """
+    tile_id, geometry, depth = tile
+    done_file = os.path.join(checkpoint_folder, tile_id + ".parquet")
+    split_file = os.path.join(checkpoint_folder, tile_id + ".split")
+    if os.path.isfile(done_file):
+        return gpd.read_parquet(done_file), []
+
+    if not os.path.isfile(split_file):
+        try:
+            features = fetch(geometry, tag)
+        except Exception as e:
+            if depth >= max_depth:
+                raise
+            print(CYEL + f"Tile {tile_id} failed, splitting it: {e}" + CEND)
+        else:
+            if features is None or len(features) < max_features or depth >= max_depth:
+                if features is None:
+                    features = gpd.GeoDataFrame(columns=[tag, "geometry"], geometry="geometry", crs="EPSG:4326")
+                features.to_parquet(done_file)
+                return features, []
+        open(split_file, "w").close()
+
+    return None, [(tile_id + i, cell, depth + 1) for i, cell in split_tile(geometry)]
+
+def fetch_adaptive(
+    polygon,
+    tag: str,
+    checkpoint_folder: str,
+    fetch=None,
+    parallel=False,
+    max_features=max_tile_features,
+    max_depth=max_tile_depth,
+):
+    """
+    Downloads the features of a polygon on a quadtree of tiles: the whole polygon is requested
+    first, and a tile is split in 4 only if its request fails or is too large, so sparse areas
+    stay in a few large tiles and dense ones are refined.
+    Every finished tile is saved in checkpoint_folder (<quadtree key>.parquet, the split ones
+    as <key>.split), so an interrupted download resumes without requesting them again.
+    fetch(polygon, tag) returns the filtered features of a tile (fetch_tile by default); a
+    local Overpass can be used by setting ox.settings.overpass_url, or another fetch passed.
+    """
+    fetch = fetch_tile if fetch is None else fetch
+    os.makedirs(checkpoint_folder, exist_ok=True)
+
+    tiles = []
+    level = [("0", polygon, 0)]
+    while level:
+        args = (itertools.repeat(tag), itertools.repeat(fetch), itertools.repeat(checkpoint_folder),
+                itertools.repeat(max_features), itertools.repeat(max_depth))
+        if parallel:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(_process_tile, level, *args))
+        else:
+            results = list(map(_process_tile, level, *args))
+
+        tiles += [features for features, _ in results if features is not None]
+        level = [child for _, children in results for child in children]
+
+    return merge_tiles(tiles, tag)
+
+def fetch_grid(polygon, tag: str, name: str, fetch=None, parallel=False):
+    fetch = fetch_tile if fetch is None else fetch
+
+    # Create a grid of smaller polygons (e.g., 5x5 grid)
+    sub_polygons = create_grid(polygon, n_rows=n_grid, n_cols=n_grid)
+
+    # every tile is reduced to [tag, "geometry"] as it arrives, and concatenated once
+    ### Parallel
+    if parallel:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            tiles = list(tqdm(executor.map(fetch, sub_polygons, itertools.repeat(tag)), total=len(sub_polygons), desc=f"Processing: {name}"))
+    else:
+        ### serial
+        tiles = [fetch(_polygon, tag) for _polygon in tqdm(sub_polygons, desc=f"Processing: {name}")]
+
+    return merge_tiles(tiles, tag)
+
 def download_osm_data(
-    gdf, subregion_col: str, parent_col: str, tag: str, lvl: int, country_filter: str, parallel=False
+    gdf, subregion_col: str, parent_col: str, tag: str, lvl: int, country_filter: str, parallel=False, adaptive=True, fetch=None
 ):
+    """
+    Downloads the tag features of every region of country_filter to a shapefile, on an adaptive
+    quadtree of tiles (see fetch_adaptive), or on the fixed n_grid x n_grid grid if not adaptive.
+    """
     if gdf.crs is None:
         gdf = gdf.set_crs("EPSG:4326")
         print("Setting by default CRS: EPSG:4326. You may want to check the original CRS to avoid errors.")
@@ -65,8 +185,6 @@ def download_osm_data(
 
     print("Downloading " + "...")
 
-    tags = {tag: True}
-
     for idx, row in gdf.iterrows():
         if row[parent_col] == country_filter:
             output_path = (
@@ -85,49 +203,29 @@ def download_osm_data(
 
             if not os.path.isfile(output_file):
                 print("Starting the download of ", output_file)
-                osm_data = gpd.GeoDataFrame()
                 polygon = row.geometry            # Get the polygon geometry of the region
+                checkpoint_folder = os.path.join(os.path.dirname(output_file), "tiles")
 
-                # Create a grid of smaller polygons (e.g., 5x5 grid)
-                sub_polygons = create_grid(polygon, n_rows=n_grid, n_cols=n_grid)
-
-                ### Parallel
-                if parallel:
-                    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                        results = list(tqdm(executor.map(fetch_osm, sub_polygons, itertools.repeat(tags)), total=n_grid**2, desc=f"Processing: {row[subregion_col]}"))
-
-                    for features in results:
-                        osm_data = pd.concat([osm_data, features], ignore_index=True)
+                if adaptive:
+                    osm_data = fetch_adaptive(polygon, tag, checkpoint_folder, fetch=fetch, parallel=parallel)
                 else:
-                    ### serial
-                    for _polygon in tqdm(sub_polygons, desc=f"Processing: {row[subregion_col]}"):
-                        osm_data_small = fetch_osm(_polygon, tags)
-                        osm_data = pd.concat([osm_data, osm_data_small], ignore_index=True)
-
-                osm_data = osm_data[[tag, "geometry"]]
-
-                if tag == "building" or tag == "landuse":
-                    osm_data = osm_data.loc[
-                        (osm_data.geometry.type == "Polygon")
-                        | (osm_data.geometry.type == "MultiPolygon")
-                    ]
-                elif tag == "highway" or tag == "route":
-                    osm_data = osm_data.loc[
-                        (osm_data.geometry.type == "LineString")
-                        | (osm_data.geometry.type == "MultiLineString")
-                    ]
+                    osm_data = fetch_grid(polygon, tag, row[subregion_col], fetch=fetch, parallel=parallel)
 
                 ###
                 # Ensure the GeoDataFrame has a CRS set
                 if osm_data.crs is None:
                     osm_data = osm_data.set_crs(epsg=4326)  # Set to WGS 84 if not already set
 
-                # Reproject to a projection that uses meters
-                osm_data = osm_data.to_crs(osm_data.estimate_utm_crs())  # EPSG 3857 is a common Web Mercator projection
+                # Reproject to a projection that uses meters, estimated on the region so that a
+                # region without any feature is still written (as an empty layer)
+                if osm_data.empty:
+                    print(CYEL + f"No {tag} found in {row[subregion_col]}, writing an empty layer." + CEND)
+                utm_crs = gpd.GeoSeries([polygon], crs="EPSG:4326").estimate_utm_crs()
+                osm_data = osm_data.to_crs(utm_crs)
 
                 osm_data.to_file(output_file, driver="ESRI Shapefile")
                 print("Success ", output_file)    
-                shutil.rmtree("/home/hautervo/cache")        
+                shutil.rmtree(checkpoint_folder, ignore_errors=True)
             else:
                 print("File already exists: ", output_file)
         
@@ -139,6 +237,48 @@ def fetch_osm(polygon, tags):
     osm_data = ox.features_from_polygon(polygon_gs, tags)
     return osm_data
 
+def filter_tile(features, tag: str):
+    """
+    Keeps only the tag column and the geometry types of the tag (see geometry_types).
+    The OSM (element, id) index is kept to drop the features returned by several tiles.
+    """
+    if features is None or features.empty or tag not in features.columns:
+        return None
+    features = features[[tag, "geometry"]]
+    if tag in geometry_types:
+        features = features.loc[features.geometry.geom_type.isin(geometry_types[tag])]
+    return features
+
+def _fetch_tile(polygon, tag: str):
+    try:
+        features = fetch_osm(polygon, {tag: True})
+    except ox._errors.InsufficientResponseError:
+        return None  # no feature in this tile
+    return filter_tile(features, tag)
+
+def fetch_tile(polygon, tag: str, cache=None):
+    """
+    Filtered features of a tile, from the cache (osm_cache by default) if the same polygon
+    and tag were already requested for the same osm_date (for the same day if osm_date is
+    None). Failed requests are not cached.
+    """
+    cache = osm_cache if cache is None else cache
+    key = cache.key(
+        "osm_tile", polygon=polygon, tags={tag: True}, date=osm_date if osm_date is not None else date.today().isoformat()
+    )
+    return cache.cached(key, lambda: _fetch_tile(polygon, tag))
+
+def merge_tiles(tiles, tag: str):
+    """
+    Concatenates the filtered tiles at once, a feature crossing tiles being kept once.
+    """
+    tiles = [tile for tile in tiles if tile is not None and not tile.empty]
+    if not tiles:
+        return gpd.GeoDataFrame(columns=[tag, "geometry"], geometry="geometry", crs="EPSG:4326")
+    osm_data = pd.concat(tiles)
+    osm_data = osm_data[~osm_data.index.duplicated()]
+    return gpd.GeoDataFrame(osm_data.reset_index(drop=True), geometry="geometry", crs=tiles[0].crs)
+
 def merge_shp(shp_list, region_nm):
     print("Starting the merge of ", region_nm)
     the_path = "/home/hautervo/Documents/Data/osm/tmp/" + region_nm + "/"
@@ -211,7 +351,6 @@ if __name__ == "__main__":
     gdf = gdf[gdf.is_valid & ~gdf.is_empty]
 
     download_osm_data(gdf, subregion_col, parent_col, "building", lvl, country_filter=country, parallel=parallel)
-    # shutil.rmtree("/home/hautervo/cache")
 
     # merge_shp(place_list, "FR-ARA")
 
@@ -1,54 +1,230 @@
-import osmium
 import json
+import os
+
+import geopandas as gpd
+import numpy as np
+import osmium
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyogrio
+import shapely
+from pyproj import Transformer
 
 data_folder = "/data/mineralogie/hautervo/data/geofabrik/"
-pbf_file = data_folder + "europe-latest.osm.pbf" 
+pbf_file = data_folder + "europe-latest.osm.pbf"
+
+batch_size = 50000  # buildings parsed before being filtered and written at once
+area_crs = "ESRI:54009"  # equal-area (Mollweide), the CRS of the GADM admin units
+tags_to_keep = ["building", "building:levels", "building:use", "building:material", "amenity"]
+
 
 class BuildingHandler(osmium.SimpleHandler):
-    def __init__(self):
+    """
+    Streams the building polygons (closed ways and multipolygon relations) of a PBF file. They
+    are passed by batches of batch_size to process_batch as shapely geometries (WGS84), so the
+    file is never held in memory. If bbox (min lon, min lat, max lon, max lat) is given, the
+    buildings whose first node is outside are skipped before their geometry is built.
+    """
+
+    def __init__(self, bbox=None, tags=tags_to_keep, batch_size=batch_size):
         super().__init__()
-        self.buildings = []
-
-    def way(self, w):
-        # Check if the way has a "building" tag
-        if 'building' in w.tags:
-            # Collect the way if it has valid geometry
-            try:
-                coords = [(node.lon, node.lat) for node in w.nodes]
-                self.buildings.append({
-                    "type": "Feature",
-                    "geometry": {
-                        "type": "Polygon",
-                        "coordinates": [coords]
-                    },
-                    "properties": {
-                        "id": w.id,
-                        "tags": dict(w.tags)
-                    }
-                })
-            except osmium.InvalidLocationError:
-                pass  # Skip invalid geometries
-
-# Bounding box for Paris (approximate)
-bbox = [2.2241, 48.8156, 2.4699, 48.9022]
-
-# Initialize handler and apply to the PBF file
-handler = BuildingHandler()
-handler.apply_file(pbf_file, locations=True)
-
-# Filter buildings within the bounding box
-filtered_buildings = [
-    b for b in handler.buildings
-    if bbox[0] <= b["geometry"]["coordinates"][0][0][0] <= bbox[2]
-    and bbox[1] <= b["geometry"]["coordinates"][0][0][1] <= bbox[3]
-]
-
-# Save to GeoJSON
-with open(data_folder + "paris_buildings.geojson", "w") as f:
-    geojson = {
-        "type": "FeatureCollection",
-        "features": filtered_buildings
-    }
-    json.dump(geojson, f, indent=2)
-
-print(f"Extracted {len(filtered_buildings)} buildings.")
+        self.bbox = bbox
+        self.tags = tags
+        self.batch_size = batch_size
+
+        self._wkb_factory = osmium.geom.WKBFactory()
+        self._ids = []
+        self._types = []
+        self._tags = []
+        self._wkbs = []
+
+    def _in_bbox(self, a):
+        for ring in a.outer_rings():
+            for node in ring:
+                return (
+                    self.bbox[0] <= node.lon <= self.bbox[2]
+                    and self.bbox[1] <= node.lat <= self.bbox[3]
+                )
+        return False
+
+    def area(self, a):
+        if "building" not in a.tags:
+            return
+        try:
+            if self.bbox is not None and not self._in_bbox(a):
+                return
+            wkb = self._wkb_factory.create_multipolygon(a)
+        except (osmium.InvalidLocationError, RuntimeError):
+            return  # Skip invalid geometries
+
+        self._ids.append(a.orig_id())
+        self._types.append("way" if a.from_way() else "relation")
+        self._tags.append([a.tags.get(tag) for tag in self.tags])
+        self._wkbs.append(wkb)
+        if len(self._ids) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._ids:
+            return
+        geometries = shapely.from_wkb(self._wkbs)
+        self.process_batch(np.array(self._ids), np.array(self._types), self._tags, geometries)
+        self._ids, self._types, self._tags, self._wkbs = [], [], [], []
+
+    def process_batch(self, ids, types, tags, geometries):
+        """
+        Called with every batch: ids and types (way or relation) as arrays, tags as one list
+        of values per building (in the order of self.tags) and geometries as shapely polygons.
+        Does nothing here, the subclasses override it.
+        """
+        pass
+
+    def run(self, pbf_file):
+        self.apply_file(pbf_file, locations=True)
+        self.flush()
+
+
+class GeoPackage_Sink:
+    """
+    Appends the buildings of every region to its own layer of a GeoPackage.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self._layers = set()
+
+    def write(self, region, gdf):
+        pyogrio.write_dataframe(
+            gdf, self.file, layer=str(region), driver="GPKG", append=os.path.isfile(self.file) and str(region) in self._layers
+        )
+        self._layers.add(str(region))
+
+    def close(self):
+        pass
+
+
+class Parquet_Sink:
+    """
+    Appends the buildings of every region to <folder>/<region>.parquet, the geometry being
+    stored as WKB with GeoParquet metadata. Every write is a new row group. The schema is
+    fixed from the tags, so that a tag missing from a whole batch is still a string column.
+    """
+
+    def __init__(self, folder, tags=tags_to_keep):
+        self.folder = folder
+        self.tags = tags
+        self._writers = {}
+
+    def _schema(self, crs):
+        geo = {
+            "version": "1.0.0",
+            "primary_column": "geometry",
+            "columns": {"geometry": {"encoding": "WKB", "geometry_types": [], "crs": crs.to_json_dict()}},
+        }
+        fields = [("osm_id", pa.int64()), ("osm_type", pa.string())]
+        fields += [(tag, pa.string()) for tag in self.tags] + [("geometry", pa.binary())]
+        return pa.schema(fields, metadata={b"geo": json.dumps(geo).encode()})
+
+    def write(self, region, gdf):
+        if region not in self._writers:
+            os.makedirs(self.folder, exist_ok=True)
+            self._writers[region] = pq.ParquetWriter(os.path.join(self.folder, f"{region}.parquet"), self._schema(gdf.crs))
+        writer = self._writers[region]
+        writer.write_table(pa.Table.from_pandas(gdf.to_wkb(), schema=writer.schema, preserve_index=False))
+
+    def close(self):
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+
+
+class BuildingExtractor(BuildingHandler):
+    """
+    Extracts in one pass the buildings of many regions: regions is a GeoDataFrame (any CRS)
+    whose region_col names the output layers. A building is written for every region it
+    intersects, with its OSM id, type (way or relation) and tags.
+    """
+
+    def __init__(self, regions, region_col: str, sink, tags=tags_to_keep, batch_size=batch_size):
+        regions = regions.to_crs("EPSG:4326") if regions.crs is not None else regions
+        super().__init__(bbox=tuple(regions.total_bounds), tags=tags, batch_size=batch_size)
+
+        self.region_names = regions[region_col].to_numpy()
+        self.tree = shapely.STRtree(regions.geometry.values)
+        self.sink = sink
+        self.counts = pd.Series(0, index=self.region_names)
+
+    def process_batch(self, ids, types, tags, geometries):
+        building_idx, region_idx = self.tree.query(geometries, predicate="intersects")
+        if len(building_idx) == 0:
+            return
+
+        tags = pd.DataFrame(tags, columns=self.tags)
+        for r in np.unique(region_idx):
+            selected = building_idx[region_idx == r]
+            gdf = gpd.GeoDataFrame(
+                {"osm_id": ids[selected], "osm_type": types[selected], **{tag: tags[tag].values[selected] for tag in self.tags}},
+                geometry=geometries[selected],
+                crs="EPSG:4326",
+            )
+            self.sink.write(self.region_names[r], gdf)
+            self.counts[self.region_names[r]] += len(selected)
+
+    def run(self, pbf_file):
+        try:
+            super().run(pbf_file)
+        finally:
+            self.sink.close()
+        return self.counts
+
+
+class BuildingAreaAggregator(BuildingHandler):
+    """
+    Building area (m2 in area_crs) and count of every admin unit in one pass over a PBF,
+    without writing the buildings. A building is assigned to the unit containing its
+    representative point, so it is counted once even if it crosses a border.
+    """
+
+    def __init__(self, regions, region_col: str, area_crs=area_crs, batch_size=batch_size):
+        regions = regions.to_crs("EPSG:4326") if regions.crs is not None else regions
+        super().__init__(bbox=tuple(regions.total_bounds), tags=[], batch_size=batch_size)
+
+        self.region_col = region_col
+        self.region_names = regions[region_col].to_numpy()
+        self.tree = shapely.STRtree(regions.geometry.values)
+        self.transformer = Transformer.from_crs("EPSG:4326", area_crs, always_xy=True)
+        self.areas = np.zeros(len(regions))
+        self.counts = np.zeros(len(regions), dtype=np.int64)
+
+    def process_batch(self, ids, types, tags, geometries):
+        point_idx, region_idx = self.tree.query(shapely.point_on_surface(geometries), predicate="intersects")
+        # a point on a shared border goes to the first unit only
+        point_idx, first = np.unique(point_idx, return_index=True)
+        region_idx = region_idx[first]
+        if len(point_idx) == 0:
+            return
+
+        projected = shapely.transform(geometries[point_idx], self.transformer.transform, interleaved=False)
+        self.areas += np.bincount(region_idx, weights=shapely.area(projected), minlength=len(self.areas))
+        self.counts += np.bincount(region_idx, minlength=len(self.counts))
+
+    def run(self, pbf_file):
+        """
+        Returns one row per unit: region_col, building_area and building_count.
+        """
+        super().run(pbf_file)
+        return pd.DataFrame(
+            {self.region_col: self.region_names, "building_area": self.areas, "building_count": self.counts}
+        )
+
+
+if __name__ == "__main__":
+    # Bounding box for Paris (approximate)
+    bbox = [2.2241, 48.8156, 2.4699, 48.9022]
+    regions = gpd.GeoDataFrame({"name": ["paris"]}, geometry=[shapely.box(*bbox)], crs="EPSG:4326")
+
+    extractor = BuildingExtractor(regions, "name", GeoPackage_Sink(data_folder + "paris_buildings.gpkg"))
+    counts = extractor.run(pbf_file)
+
+    print(f"Extracted {counts['paris']} buildings.")
@@ -1,102 +1,41 @@
 import os
 import rasterio
-from rasterio.mask import mask
 import geopandas as gpd
-from shapely.geometry import mapping
-from concurrent.futures import ThreadPoolExecutor
-import itertools
 import pycountry
 
 import numpy as np
 import sys
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Clip_Executor import Clip_Executor
+
 # ipdb.set_trace()
 max_workers = 32
 
 
-def make_children(shapefile_path, raster_path, output_path, col_name: str):
+def make_children(shapefile_path, raster_path, output_path, col_name: str, max_workers=max_workers):
     shapefile = gpd.read_file(shapefile_path)
-     
-    with rasterio.open(raster_path) as src:  
-        crs = src.crs
-
-    if shapefile.crs != crs:
-        shapefile = shapefile.to_crs(crs)
-    # Read the raster file
-    with rasterio.open(raster_path) as src:      
-        for index, row in shapefile.iterrows():
-            output_raster_path = os.path.join(output_path, f"{row[col_name]}.tif")
-            if not os.path.isfile(output_raster_path):                
-                geometry = row.geometry
-                shape = [mapping(geometry)]
-
-                # Mask the raster with the individual shape
-                out_image, out_transform = mask(src, shape, crop=True)
-                out_meta = src.meta.copy()
-
-                # Update the metadata with new dimensions, transform, and CRS
-                out_meta.update(
-                    {
-                        "driver": "GTiff",
-                        "height": out_image.shape[1],
-                        "width": out_image.shape[2],
-                        "transform": out_transform,
-                        "dtype": out_image.dtype,
-                        "compress": "lzw",  # lossless compression algorithm
-                    }
-                )
-
-                # Define the output raster path
-                
-                os.makedirs(os.path.dirname(output_raster_path), exist_ok=True)
-
-                # Save the clipped raster to a new file
-                with rasterio.open(output_raster_path, "w", **out_meta) as dest:
-                    dest.write(out_image)
-                print("Done: ", row[col_name])
+
+    # one process per worker, each opening the raster once
+    report = Clip_Executor(raster_path, max_workers=max_workers).run_gdf(shapefile, col_name, output_path)
+    for _, row in report.loc[report["status"] == "done"].iterrows():
+        print("Done: ", row["name"])
+
+    return report
 
 
 def make_one_child(shapefile_path, raster_path, output_path, col_name: str, id: str):
     shapefile = gpd.read_file(shapefile_path)
-    # Ensure the shapefile geometry is in the same coordinate system as the raster
-    with rasterio.open(raster_path) as src:
-        crs = src.crs
-
-    if shapefile.crs != crs:
-        shapefile = shapefile.to_crs(crs)
-
-    # Read the raster file
-    with rasterio.open(raster_path) as src:
-        for index, row in shapefile.iterrows():
-            if id == row[col_name]:
-                print("Found: ", row[col_name])
-                geometry = row.geometry
-                shape = [mapping(geometry)]
-
-                # Mask the raster with the individual shape
-                out_image, out_transform = mask(src, shape, crop=True)
-                out_meta = src.meta.copy()
-
-                # Update the metadata with new dimensions, transform, and CRS
-                out_meta.update(
-                    {
-                        "driver": "GTiff",
-                        "height": out_image.shape[1],
-                        "width": out_image.shape[2],
-                        "transform": out_transform,
-                        "dtype": out_image.dtype,
-                        "compress": "lzw",  # lossless compression algorithm
-                    }
-                )
-
-                # Define the output raster path
-                output_raster_path = os.path.join(output_path, f"{row[col_name]}.tif")
-                os.makedirs(os.path.dirname(output_raster_path), exist_ok=True)
-
-                # Save the clipped raster to a new file
-                with rasterio.open(output_raster_path, "w", **out_meta) as dest:
-                    dest.write(out_image)
-                print("END ", output_raster_path)
+    shapefile = shapefile[shapefile[col_name] == id]
+    if shapefile.empty:
+        print(id, " was not found.")
+        return
+
+    print("Found: ", id)
+    report = Clip_Executor(raster_path, max_workers=1, overwrite=True).run_gdf(shapefile, col_name, output_path)
+    print("END ", report["file"].iloc[0])
+
+    return report
 
 
 ### MAIN
@@ -122,9 +61,7 @@ output_path = raster_path + "subregions/"
 
 
 if __name__ == "__main__":
-    # with ThreadPoolExecutor(max_workers=max_workers) as executor:
-    #     executor.map(make_one_child, itertools.repeat(admin_units), itertools.repeat(global_raster), itertools.repeat(output_path), itertools.repeat("iso3"), )
-    # with ThreadPoolExecutor(max_workers=max_workers) as executor:
-    #     executor.map(make_children, itertools.repeat(admin_units), loop_raster, loop_output_path, itertools.repeat("iso3"), )
+    # for raster, output in zip(loop_raster, loop_output_path):
+    #     make_children(admin_units, raster, output, "iso3")
     make_children(admin_units, global_raster, output_path, "iso3")
     print("Job done.")